@@ -1,12 +1,15 @@
 from abc import abstractmethod
 import os
+import collections
+import contextlib
+import contextvars
 import string
 import re
 import asyncio
 import random
 import telethon
 import telethon.sessions
-from celery import Celery
+from celery import Celery, chain, chord
 from celery.utils.log import get_task_logger
 from . import models, utils, exceptions
 
@@ -25,43 +28,168 @@ logger = get_task_logger(__name__)
 
 
 class Task(app.Task):
+    max_retries = int(os.environ.get('CELERY_FLOOD_MAX_RETRIES', 10))
+
+    _stored_media = utils.SharedCache("media", ttl=float(os.environ.get('CELERY_MEDIA_DEDUP_TTL', 2592000)))
+
     @abstractmethod
     def run(self, *args, **kswargs):
         """Start the task work"""
 
         raise NotImplementedError
 
+    def _retry_later(self, ex: 'telethon.errors.FloodWaitError | telethon.errors.TakeoutInitDelayError'):
+        """Reschedule task after telegram wait instead of sleeping in worker slot"""
+
+        logger.warning(f"Task {self.name} is retried in {ex.seconds}. Exception {ex}")
+
+        return self.retry(exc=ex, countdown=ex.seconds)
+
+    @staticmethod
+    def _find_phones(parser_id: 'str') -> 'list[models.TypePhone]':
+        """Returns ready phones of parser and flooded ones, which flood wait may be expired"""
+
+        return (
+            models.Phone.find(status=models.Phone.READY, parser=parser_id)
+            + models.Phone.find(status=models.Phone.FLOOD, parser=parser_id)
+        )
+
+    @staticmethod
+    def _run_async(coro):
+        """Run coroutine in a new event loop with task scoped identity map, release API and cache connections after"""
+
+        async def wrapper():
+            try:
+                with models.IdentityMap():
+                    return await coro
+            finally:
+                await utils.SharedCache.aclose()
+                await utils.ApiService().aclose()
+
+        return asyncio.run(wrapper())
+
+    @classmethod
+    async def _enqueue_media(cls, client: 'utils.TypeTelegramClient', media: 'models.TypeEntity', loc,
+                             file_size: 'int', extension: 'str'):
+        """Link media to already stored file with the same content or send download job to media queue"""
+
+        path = await cls._stored_media.aget(utils.location_key(loc))
+
+        if path is not None:
+            media.path = path
+
+            await media.asave()
+
+            return
+
+        app.tasks[DownloadMediaTask.name].apply_async(
+            args=[client.phone.id, media.__class__.__name__, media.id, utils.dump_location(loc), file_size, extension]
+        )
+
 
 class ParseBaseTask(Task):
+    LINK_NEGATIVE_TTL = float(os.environ.get('CELERY_LINK_NEGATIVE_TTL', 3600))
+
+    _members = utils.SharedCache("members", ttl=float(os.environ.get('CELERY_MEMBER_TTL', 86400)))
+    _links = utils.SharedCache("links", ttl=float(os.environ.get('CELERY_LINK_TTL', 86400)))
+
+    LINKS_BATCH_SIZE = int(os.environ.get('CELERY_LINKS_BATCH_SIZE', 50))
+
+    _links_batch: 'contextvars.ContextVar[utils.Batch | None]' = contextvars.ContextVar("links_batch", default=None)
+
+    _fingerprints = utils.SharedCache("fingerprints", ttl=float(os.environ.get('CELERY_FINGERPRINT_TTL', 604800)))
+
+    _upserts: 'contextvars.ContextVar[collections.Counter | None]' = contextvars.ContextVar("upserts", default=None)
+
+    _threads = utils.SharedCache("threads", ttl=float(os.environ.get('CELERY_THREAD_TTL', 2592000)))
+
+    THREADS_BATCH_SIZE = int(os.environ.get('CELERY_THREADS_BATCH_SIZE', 10))
+
+    _threads_batch: 'contextvars.ContextVar[dict | None]' = contextvars.ContextVar("threads_batch", default=None)
+
     @classmethod
     async def __set_member_media(cls, client, member: 'models.TypeMember', tg_user: 'telethon.types.User'):
         try:
             async for photo in client.iter_profile_photos(tg_user):
                 photo: 'telethon.types.TypePhoto'
 
-                media = models.MemberMedia(
+                media = await models.MemberMedia(
                     internal_id=photo.id,
                     member=member,
                     date=photo.date.isoformat()
-                ).save()
+                ).asave()
 
                 if media.path is None:
                     loc, file_size, extension = utils.get_photo_location(photo)
 
-                    await client.download_media(media, loc, file_size, extension)
+                    await Task._enqueue_media(client, media, loc, file_size, extension)
             else:
                 return
         except telethon.errors.FloodWaitError as ex:
-            logger.warning(f"Member media download must wait. Exception {ex}")
+            # Photos are fetched again with the next member update
+            logger.warning(f"Member media download skipped. Exception {ex}")
+
+    @classmethod
+    async def _upsert(cls, entity: 'models.TypeEntity', key, defer: 'bool' = False) -> 'models.TypeEntity':
+        """Save entity unless it's the same as saved last time with the same natural key"""
+
+        cache_key = f"{entity._endpoint}:{key}"
+        fingerprint = entity.fingerprint()
+        cached = await cls._fingerprints.aget(cache_key)
+        upserts = cls._upserts.get()
+
+        if cached is not None and cached["fingerprint"] == fingerprint:
+            if upserts is not None:
+                upserts[entity._endpoint, "unchanged"] += 1
 
-            await asyncio.sleep(ex.seconds)
+            entity.id = cached["id"]
+
+            return entity._identify()
+
+        if upserts is not None:
+            upserts[entity._endpoint, "changed"] += 1
+
+        await entity.asave(defer=defer)
+
+        def remember(pending: 'asyncio.Future'):
+            if not pending.cancelled() and pending.exception() is None:
+                cls._fingerprints.set_soon(cache_key, {"fingerprint": fingerprint, "id": entity.id})
+
+        if entity._pending is not None:
+            entity._pending.add_done_callback(remember)
+        else:
+            await cls._fingerprints.aset(cache_key, {"fingerprint": fingerprint, "id": entity.id})
+
+        return entity
+
+    @classmethod
+    @contextlib.contextmanager
+    def _count_upserts(cls):
+        """Count changed and unchanged entities saved in context and log them after"""
+
+        upserts = collections.Counter()
+        token = cls._upserts.set(upserts)
+
+        try:
+            yield upserts
+        finally:
+            cls._upserts.reset(token)
 
-            cls.__set_member_media(client, member, tg_user)
+            for (endpoint, state), count in sorted(upserts.items()):
+                logger.info(f"{count} {state} entities of {endpoint}.")
 
     @classmethod
     async def __set_member(cls, client, tg_user: 'telethon.types.User') -> 'models.TypeMember':
         """Create 'Member' from telegram entity"""
 
+        cached = await cls._members.aget(tg_user.id)
+
+        if cached is not None and all(
+            getattr(tg_user, field) is None or getattr(tg_user, field) == cached[field]
+            for field in ("username", "first_name", "last_name")
+        ):
+            return models.Member(**cached)
+
         new_member = {
             "internal_id": tg_user.id,
             "username": tg_user.username,
@@ -83,15 +211,17 @@ class ParseBaseTask(Task):
             new_member["phone"] = full_user.user.phone
             new_member["about"] = full_user.about
 
-        member = models.Member(**new_member).save()
+        member = await cls._upsert(models.Member(**new_member), tg_user.id)
 
         await cls.__set_member_media(client, member, tg_user)
 
+        await cls._members.aset(tg_user.id, member.serialize())
+
         return member
 
-    @staticmethod
-    def __set_chat_member(chat: 'models.TypeChat', member: 'models.TypeMember',
-                          participant=None) -> 'models.TypeChatMember':
+    @classmethod
+    async def __set_chat_member(cls, chat: 'models.TypeChat', member: 'models.TypeMember',
+                                participant=None) -> 'models.TypeChatMember':
         """Create 'ChatMember' from telegram entity"""
 
         new_chat_member = {"chat": chat, "member": member}
@@ -101,11 +231,11 @@ class ParseBaseTask(Task):
         else:
             new_chat_member["isLeft"] = True
 
-        return models.ChatMember(**new_chat_member).save()
+        return await cls._upsert(models.ChatMember(**new_chat_member), f"{chat.id}:{member.id}")
 
-    @staticmethod
-    def __set_chat_member_role(chat_member: 'models.TypeChatMember',
-                               participant=None) -> 'models.TypeChatMemberRole':
+    @classmethod
+    async def __set_chat_member_role(cls, chat_member: 'models.TypeChatMember',
+                                     participant=None) -> 'models.TypeChatMemberRole':
         """Create 'ChatMemberRole' from telegram entity"""
 
         new_chat_member_role = {"member": chat_member}
@@ -120,7 +250,7 @@ class ParseBaseTask(Task):
             new_chat_member_role["title"] = "Участник"
             new_chat_member_role["code"] = "member"
 
-        return models.ChatMemberRole(**new_chat_member_role).save()
+        return await cls._upsert(models.ChatMemberRole(**new_chat_member_role), chat_member.id, defer=True)
 
     @classmethod
     async def _handle_user(cls, client: 'utils.TypeTelegramClient', chat: 'models.TypeChat',
@@ -131,37 +261,157 @@ class ParseBaseTask(Task):
             return None, None, None, None
 
         member = await cls.__set_member(client, tg_user)
-        chat_member = cls.__set_chat_member(chat, member, participant)
-        chat_member_role = cls.__set_chat_member_role(chat_member, participant)
+        chat_member = await cls.__set_chat_member(chat, member, participant)
+        chat_member_role = await cls.__set_chat_member_role(chat_member, participant)
 
         return member, chat_member, chat_member_role
 
     @classmethod
-    async def _handle_links(cls, client: 'utils.TypeTelegramClient', text):
-        """Handle links from message text"""
+    async def _resolve_link(cls, client: 'utils.TypeTelegramClient', username: 'str', link: 'str') -> 'bool':
+        """Resolve link and create entity from it, returns `False` if phone must wait"""
+
+        try:
+            tg_entity: 'telethon.types.TypeChat | telethon.types.User' = await client.resolve_username(username)
+
+            if isinstance(tg_entity, telethon.types.User):
+                await cls.__set_member(client, tg_entity)
+
+                await cls._links.aset(username, {"type": "user", "internal_id": tg_entity.id})
+
+                return True
+
+            await models.Chat(
+                link=link, internal_id=tg_entity.id, title=tg_entity.title, is_available=False
+            ).asave()
+
+            await cls._links.aset(username, {"type": "chat", "internal_id": tg_entity.id})
+
+            logger.info(f"New entity from link {link} created.")
+        except telethon.errors.FloodWaitError as ex:
+            logger.warning(f"Link {link} resolve must wait {ex.seconds}.")
+
+            return False
+        except (ValueError, telethon.errors.UsernameNotOccupiedError, telethon.errors.UsernameInvalidError):
+            await cls._links.aset(username, {"type": None}, ttl=cls.LINK_NEGATIVE_TTL)
+        except telethon.errors.RPCError as ex:
+            # Transient errors aren't cached, link is resolved again when it's met next time
+            logger.warning(f"Link {link} resolve failed. Exception {ex}")
+        except exceptions.RequestException:
+            pass
+
+        return True
+
+    @staticmethod
+    def _dispatch_links(chat: 'models.TypeChat', links: 'list[str]'):
+        """Send links to resolving queue"""
+
+        app.tasks[ResolveLinksTask.name].apply_async(args=[links, chat.parser.id])
+
+    @classmethod
+    async def _handle_links(cls, chat: 'models.TypeChat', text):
+        """Collect links from message text for deferred resolving"""
+
+        batch = cls._links_batch.get()
+        own_batch = batch is None
+
+        if own_batch:
+            batch = utils.Batch(lambda links: cls._dispatch_links(chat, links), cls.LINKS_BATCH_SIZE)
 
         for link in re.finditer(utils.LINK_RE, text):
             _link = link.group()
             username, is_join_chat = utils.parse_username(_link)
 
-            if not username:
+            if not username or is_join_chat:
                 continue
 
-            if not is_join_chat:
-                try:
-                    tg_entity: 'telethon.types.TypeChat | telethon.types.User' = await client.get_entity(username)
+            if await cls._links.aget(username) is not None:
+                continue
 
-                    if isinstance(tg_entity, telethon.types.User):
-                        await cls.__set_member(client, tg_entity)
+            batch.add(username, _link)
 
-                        continue
+        if own_batch:
+            batch.flush()
+
+    @classmethod
+    @contextlib.contextmanager
+    def _collect_links(cls, chat: 'models.TypeChat'):
+        """Collect links of all handled messages in one deduplicated batch"""
 
-                    models.Chat(link=_link, internal_id=tg_entity.id, title=tg_entity.title, is_available=False).save()
+        batch = utils.Batch(lambda links: cls._dispatch_links(chat, links), cls.LINKS_BATCH_SIZE)
+        token = cls._links_batch.set(batch)
 
-                    logger.info(f"New entity from link {_link} created.")
+        try:
+            yield batch
+        finally:
+            cls._links_batch.reset(token)
 
-                except (ValueError, exceptions.RequestException, telethon.errors.RPCError):
-                    continue
+            batch.flush()
+
+    @classmethod
+    async def _handle_thread(cls, client, chat: 'models.TypeChat', tg_message: 'telethon.types.Message',
+                             min_id: 'int'):
+        """Handle comments of channel post newer than `min_id` and mark thread as complete"""
+
+        async for reply in client.iter_messages(tg_message.input_chat, reply_to=tg_message.id, min_id=min_id):
+            if not isinstance(reply, telethon.types.Message):
+                continue
+
+            await cls._handle_links(chat, reply.message)
+
+            await cls._handle_message(client, chat, reply)
+
+        await cls._threads.aset(f"{chat.id}:{tg_message.id}", tg_message.replies.max_id)
+
+    @classmethod
+    async def _flush_threads(cls, client, chat: 'models.TypeChat', batch: 'dict'):
+        """Handle pending threads concurrently"""
+
+        threads = list(batch.values())
+        batch.clear()
+
+        await asyncio.gather(*(cls._handle_thread(client, chat, tg_message, min_id) for tg_message, min_id in threads))
+
+    @classmethod
+    async def _add_thread(cls, client, chat: 'models.TypeChat', tg_message: 'telethon.types.Message'):
+        """Handle new comments of channel post, batched with other posts if threads are collected"""
+
+        replies = tg_message.replies
+
+        # Replies in groups are in chat history itself, only channel posts have separate threads
+        if replies is None or not replies.comments or not replies.replies:
+            return
+
+        min_id = await cls._threads.aget(f"{chat.id}:{tg_message.id}") or 0
+
+        if replies.max_id is not None and replies.max_id <= min_id:
+            return
+
+        batch = cls._threads_batch.get()
+
+        if batch is None:
+            await cls._handle_thread(client, chat, tg_message, min_id)
+
+            return
+
+        batch[tg_message.id] = (tg_message, min_id)
+
+        if len(batch) >= cls.THREADS_BATCH_SIZE:
+            await cls._flush_threads(client, chat, batch)
+
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def _collect_threads(cls, client, chat: 'models.TypeChat'):
+        """Collect comment threads of all handled posts and fetch them in batches"""
+
+        batch = {}
+        token = cls._threads_batch.set(batch)
+
+        try:
+            yield batch
+        finally:
+            cls._threads_batch.reset(token)
+
+        await cls._flush_threads(client, chat, batch)
 
     @staticmethod
     def _get_fwd(fwd_from):
@@ -200,36 +450,32 @@ class ParseBaseTask(Task):
         else:
             return
 
-        media = models.MessageMedia(internal_id=loc.id, message=message, date=date).save()
+        await message.flushed()
+
+        media = await models.MessageMedia(internal_id=loc.id, message=message, date=date).asave()
 
         if media.path is None:
-            await client.download_media(media, loc, file_size, extension)
+            await Task._enqueue_media(client, media, loc, file_size, extension)
 
     @classmethod
     async def _handle_message(cls, client, chat: 'models.TypeChat', tg_message: 'telethon.types.TypeMessage'):
         """Handle telegram message"""
 
         if isinstance(tg_message.from_id, telethon.types.PeerUser):
-            user: 'telethon.types.TypeUser' = await client.get_entity(tg_message.from_id)
+            user: 'telethon.types.TypeUser' = tg_message.sender
+
+            if not isinstance(user, telethon.types.User) or user.min:
+                user = await client.get_entity(tg_message.from_id)
 
             member, chat_member, chat_member_role = await cls._handle_user(client, chat, user)
         else:
             chat_member = models.ChatMember()
 
         if tg_message.reply_to is not None:
-            reply_to = models.Message(internal_id=tg_message.reply_to.reply_to_msg_id, chat=chat).save()
+            reply_to = await models.Message(internal_id=tg_message.reply_to.reply_to_msg_id, chat=chat).asave()
         else:
             reply_to = models.Message()
 
-        if tg_message.replies is not None:
-            async for reply in client.iter_messages(tg_message.input_chat, reply_to=tg_message.id):
-                if not isinstance(reply, telethon.types.Message):
-                    continue
-
-                await cls._handle_links(client, reply.message)
-
-                await cls._handle_message(client, chat, reply)
-
         fwd_from_id, fwd_from_name = cls._get_fwd(tg_message.fwd_from)
 
         message = models.Message(
@@ -244,11 +490,13 @@ class ParseBaseTask(Task):
             grouped_id=tg_message.grouped_id,
             date=tg_message.date.isoformat()
         )
-        message.save()
+        await message.asave(defer=True)
 
         if tg_message.media is not None:
             await cls.__set_message_media(client, message, tg_message)
 
+        await cls._add_thread(client, chat, tg_message)
+
     @staticmethod
     def before_start(task_id, args, kwargs):
         try:
@@ -310,7 +558,7 @@ class PhoneAuthorizationTask(Task):
             phone.status = models.Phone.BAN
             phone.status_text = str(ex)
             phone.code = None
-            phone.save()
+            await phone.asave()
 
             raise
 
@@ -333,7 +581,7 @@ class PhoneAuthorizationTask(Task):
         except exceptions.RequestException as ex:
             return f"{ex}"
 
-        return asyncio.run(self._run(phone))
+        return self._run_async(self._run(phone))
 
 
 app.register_task(PhoneAuthorizationTask())
@@ -360,14 +608,16 @@ class ChatResolveTask(Task):
 
         photo = entity.full_chat.chat_photo
 
-        media = models.ChatMedia(internal_id=photo.id, chat=chat, date=photo.date.isoformat()).save()
+        media = await models.ChatMedia(internal_id=photo.id, chat=chat, date=photo.date.isoformat()).asave()
 
         if media.path is None:
             loc, file_size, extension = utils.get_photo_location(photo)
 
-            await client.download_media(media, loc, file_size, extension)
+            await Task._enqueue_media(client, media, loc, file_size, extension)
 
     async def _run(self, chat: 'models.TypeChat', phones: 'list[models.TypePhone]'):
+        phones = await utils.TelegramClient.SCHEDULER.order(phones, rpc="ResolveUsernameRequest")
+
         for phone in phones:
             try:
                 async with utils.TelegramClient(phone) as client:
@@ -380,7 +630,7 @@ class ChatResolveTask(Task):
                     except (ValueError, telethon.errors.RPCError) as ex:
                         chat.status = models.Chat.FAILED
                         chat.status_text = str(ex)
-                        chat.save()
+                        await chat.asave()
 
                         raise ex
                     else:
@@ -389,7 +639,7 @@ class ChatResolveTask(Task):
 
                             chat.status = models.Chat.FAILED
                             chat.status_text = "User link."
-                            chat.save()
+                            await chat.asave()
 
                             raise "User link."
 
@@ -409,7 +659,7 @@ class ChatResolveTask(Task):
 
                         chat.title = tg_chat.title
                         chat.status = models.Chat.AVAILABLE
-                        chat.save()
+                        await chat.asave()
 
                         return True
             except exceptions.UnauthorizedError as ex:
@@ -428,13 +678,13 @@ class ChatResolveTask(Task):
             raise Exception("Can't get given chat.")
 
         try:
-            phones = models.Phone.find(status=models.Phone.READY, parser=chat.parser.id)
+            phones = self._find_phones(chat.parser.id)
         except exceptions.RequestException as ex:
             logger.error(f"{ex}")
 
             raise Exception("Can't get phones.")
 
-        return asyncio.run(self._run(chat, phones))
+        return self._run_async(self._run(chat, phones))
 
 
 app.register_task(ChatResolveTask())
@@ -445,50 +695,47 @@ class JoinChatTask(Task):
     queue = "high_prio"
 
     async def _run(self, chat: 'models.TypeChat', phone: 'models.TypePhone'):
-        while True:
-            async with utils.TelegramClient(phone) as client:
-                try:
-                    tg_chat = await client.join(chat.link)
-                except telethon.errors.FloodWaitError as ex:
-                    logger.warning(f"Chat wiring for phone {phone.id} must wait {ex.seconds}.")
-
-                    await asyncio.sleep(ex.seconds)
+        async with utils.TelegramClient(phone) as client:
+            try:
+                tg_chat = await client.join(chat.link)
+            except telethon.errors.FloodWaitError as ex:
+                raise self._retry_later(ex)
+            except telethon.errors.ChannelsTooMuchError as ex:
+                phone.status = models.Phone.FULL
+                phone.status_text = str(ex)
+                await phone.asave()
+
+                raise ex
+            except (ValueError, telethon.errors.RPCError) as ex:
+                chat.status = models.Chat.FAILED
+                chat.status_text = str(ex)
+                await chat.asave()
+
+                raise ex
+            else:
+                await models.ChatPhone(chat=chat, phone=phone, is_using=True).asave()
 
-                    continue
-                except telethon.errors.ChannelsTooMuchError as ex:
-                    phone.status = models.Phone.FULL
-                    phone.status_text = str(ex)
-                    phone.save()
-
-                    raise ex
-                except (ValueError, telethon.errors.RPCError) as ex:
-                    chat.status = models.Chat.FAILED
-                    chat.status_text = str(ex)
-                    chat.save()
-
-                    raise ex
-                else:
-                    models.ChatPhone(chat=chat, phone=phone, is_using=True).save()
+                await utils.TelegramClient.SCHEDULER.add_dialog(phone.id)
 
-                    chat.internal_id = telethon.utils.get_peer_id(tg_chat)
-                    chat.total_messages = await client.get_messages_count(tg_chat)
-                    chat.total_members = await client.get_participants_count(tg_chat)
-                    chat.title = tg_chat.title
-                    chat.save()
+                chat.internal_id = telethon.utils.get_peer_id(tg_chat)
+                chat.total_messages = await client.get_messages_count(tg_chat)
+                chat.total_members = await client.get_participants_count(tg_chat)
+                chat.title = tg_chat.title
+                await chat.asave()
 
-                    await asyncio.sleep(random.randint(2, 5))
+                await asyncio.sleep(random.randint(2, 5))
 
-                    messages = await client.get_messages(tg_chat, limit=3)
+                messages = await client.get_messages(tg_chat, limit=3)
 
-                    for tg_message in messages:
-                        models.Message(
-                            internal_id=tg_message.id,
-                            text=tg_message.message,
-                            chat=chat,
-                            date=tg_message.date.isoformat()
-                        ).save()
+                for tg_message in messages:
+                    await models.Message(
+                        internal_id=tg_message.id,
+                        text=tg_message.message,
+                        chat=chat,
+                        date=tg_message.date.isoformat()
+                    ).asave()
 
-                    return True
+                return True
 
     def run(self, chat_id: 'str', phone_id: 'str'):
         try:
@@ -505,7 +752,7 @@ class JoinChatTask(Task):
 
             raise Exception("Can't get given phone.")
 
-        return asyncio.run(self._run(chat, phone))
+        return self._run_async(self._run(chat, phone))
 
 
 app.register_task(JoinChatTask())
@@ -516,39 +763,36 @@ class ChatMediaTask(Task):
     queue = "low_prio"
 
     async def _run(self, chat: 'models.TypeChat', chat_phones: 'list[models.TypeChatPhone]'):
+        chat_phones = await utils.TelegramClient.SCHEDULER.order(chat_phones, lambda chat_phone: chat_phone.phone)
+
         for chat_phone in chat_phones:
             try:
-                async with utils.TelegramClient(chat_phone.phone) as client:
+                async with utils.TelegramClient(await chat_phone.phone.aresolve()) as client:
                     id, peer = telethon.utils.resolve_id(chat.internal_id)
 
-                    while True:
-                        try:
-                            async for photo in client.iter_profile_photos(peer):
-                                photo: 'telethon.types.TypePhoto'
-
-                                media = models.ChatMedia(
-                                    internal_id=photo.id,
-                                    chat=chat,
-                                    date=photo.date.isoformat()
-                                ).save()
-
-                                if media.path is None:
-                                    loc, file_size, extension = utils.get_photo_location(photo)
+                    try:
+                        async for photo in client.iter_profile_photos(peer):
+                            photo: 'telethon.types.TypePhoto'
 
-                                    await client.download_media(media, loc, file_size, extension)
-                            else:
-                                return
-                        except telethon.errors.FloodWaitError as ex:
-                            logger.warning(f"Chat media download must wait. Exception {ex}")
+                            media = await models.ChatMedia(
+                                internal_id=photo.id,
+                                chat=chat,
+                                date=photo.date.isoformat()
+                            ).asave()
 
-                            await asyncio.sleep(ex.seconds)
+                            if media.path is None:
+                                loc, file_size, extension = utils.get_photo_location(photo)
 
-                            continue
+                                await Task._enqueue_media(client, media, loc, file_size, extension)
+                        else:
+                            return
+                    except telethon.errors.FloodWaitError as ex:
+                        raise self._retry_later(ex)
             except exceptions.UnauthorizedError as ex:
                 logger.critical(f"{ex}")
 
                 chat_phone.is_using = False
-                chat_phone.save()
+                await chat_phone.asave()
 
                 continue
 
@@ -569,7 +813,7 @@ class ChatMediaTask(Task):
 
             raise Exception("Can't get chat wired phones.")
 
-        return asyncio.run(self._run(chat, chat_phones))
+        return self._run_async(self._run(chat, chat_phones))
 
 
 app.register_task(ChatMediaTask())
@@ -586,44 +830,49 @@ class ParseMembersTask(ParseBaseTask):
         # search = string.digits + string.ascii_lowercase + string.punctuation + ' ♥абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
         search = string.ascii_lowercase + '♥абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
 
-        async for user in client.iter_participants(entity=chat.internal_id, search=search, aggressive=True):
-            await cls._handle_user(client, chat, user, user.participant)
-        else:
-            logger.info("Members data download success.")
+        with cls._count_upserts():
+            async with utils.WriteBehindBuffer():
+                async for user in client.iter_participants(entity=chat.internal_id, search=search, aggressive=True,
+                                                           adaptive=True):
+                    await cls._handle_user(client, chat, user, user.participant)
+                else:
+                    logger.info("Members data download success.")
 
     async def _run(self, chat: 'models.TypeChat', chat_phones: 'list[models.TypeChatPhone]'):
-        for chat_phone in chat_phones:
-            phone = chat_phone.phone
-
-            if phone.takeout:
-                continue
-
-            try:
-                async with utils.TelegramClient(phone) as client:
-                    while True:
-                        try:
-                            async with client.takeout(users=True, chats=True, megagroups=True, channels=True,
-                                                      files=True, max_file_size=2147483647) as takeout:
-                                await self._get_members(takeout, chat)
-                        except telethon.errors.TakeoutInitDelayError as ex:
-                            logger.warning('Must wait', ex.seconds, 'before takeout')
+        chat_phones = await utils.TelegramClient.SCHEDULER.order(chat_phones, lambda chat_phone: chat_phone.phone,
+                                                                 rpc="GetParticipantsRequest")
 
-                            await asyncio.sleep(ex.seconds)
+        for chat_phone in chat_phones:
+            phone = await chat_phone.phone.aresolve()
 
-                            continue
-                        except telethon.errors.TakeoutInvalidError as ex:
-                            logger.error(f"{ex}")
+            # Takeout is held by one task at a time, other phones are tried meanwhile
+            async with utils.TelegramClient.SCHEDULER.lease(phone.id) as leased:
+                if phone.takeout or not leased:
+                    continue
 
-                            break
-                        else:
-                            return True
-            except exceptions.UnauthorizedError as ex:
-                logger.critical(f"{ex}")
+                try:
+                    async with utils.TelegramClient(phone) as client:
+                        while True:
+                            try:
+                                async with client.takeout(users=True, chats=True, megagroups=True, channels=True,
+                                                          files=True, max_file_size=2147483647) as takeout:
+                                    await self._get_members(takeout, chat)
+                            except (telethon.errors.TakeoutInitDelayError, telethon.errors.FloodWaitError) as ex:
+                                # Unchanged members are skipped by fingerprints after retry
+                                raise self._retry_later(ex)
+                            except telethon.errors.TakeoutInvalidError as ex:
+                                logger.error(f"{ex}")
+
+                                break
+                            else:
+                                return True
+                except exceptions.UnauthorizedError as ex:
+                    logger.critical(f"{ex}")
 
-                chat_phone.is_using = False
-                chat_phone.save()
+                    chat_phone.is_using = False
+                    await chat_phone.asave()
 
-                continue
+                    continue
 
         raise Exception("Chat doesn't have available phones, try again later.")
 
@@ -642,7 +891,7 @@ class ParseMembersTask(ParseBaseTask):
 
             raise Exception("Can't get chat wired phones.")
 
-        return asyncio.run(self._run(chat, chat_phones))
+        return self._run_async(self._run(chat, chat_phones))
 
 
 app.register_task(ParseMembersTask())
@@ -652,59 +901,224 @@ class ParseMessagesTask(ParseBaseTask):
     name = "ParseMessagesTask"
     queue = "low_prio"
 
-    async def _get_messages(self, client, chat: 'models.TypeChat'):
-        """Iterate telegram chat messages and save to API"""
+    CONCURRENCY = int(os.environ.get('CELERY_MESSAGES_CONCURRENCY', 4))
 
-        last_messages = models.Message.find(chat=chat.id, ordering="-internal_id", limit=1)
-        max_id = last_messages[0].internal_id if last_messages else 0
+    _checkpoints = utils.SharedCache("checkpoints", ttl=float(os.environ.get('CELERY_CHECKPOINT_TTL', 604800)))
 
-        async for tg_message in client.iter_messages(chat.internal_id, max_id=max_id):
-            if not isinstance(tg_message, telethon.types.Message):
-                continue
+    CHECKPOINT_INTERVAL = max(1, int(os.environ.get('CELERY_CHECKPOINT_INTERVAL', 1000)))
 
-            await self._handle_links(client, tg_message.message)
+    WINDOW_SIZE = max(1, int(os.environ.get('CELERY_MESSAGES_WINDOW_SIZE', 10000)))
 
-            await self._handle_message(client, chat, tg_message)
+    BUSY_COUNTDOWN = int(os.environ.get('CELERY_MESSAGES_BUSY_COUNTDOWN', 300))
+
+    @staticmethod
+    def _get_message_key(tg_message: 'telethon.types.Message'):
+        """Returns key of messages which must be handled in order: album or reply thread"""
+
+        if tg_message.grouped_id is not None:
+            return "album", tg_message.grouped_id
+
+        if tg_message.reply_to is not None:
+            return tg_message.reply_to.reply_to_top_id or tg_message.reply_to.reply_to_msg_id
+
+        return tg_message.id
+
+    @staticmethod
+    def _get_watermarks(chat: 'models.TypeChat') -> 'dict | None':
+        """Returns ids range of chat messages which history is completely parsed"""
+
+        if chat.low_watermark is None or chat.high_watermark is None:
+            return None
+
+        return {"low": chat.low_watermark, "high": chat.high_watermark}
+
+    @staticmethod
+    async def _set_watermarks(chat: 'models.TypeChat', marks: 'dict'):
+        """Stores ids range of completely parsed chat history"""
+
+        await chat.areload()
+
+        chat.low_watermark = marks["low"]
+        chat.high_watermark = marks["high"]
+        await chat.asave()
+
+    async def _get_messages(self, client, chat: 'models.TypeChat', backfill: 'bool' = False,
+                            window: 'tuple[int, int] | None' = None) -> 'dict':
+        """
+        Iterate telegram chat messages and save to API, returns ids range of parsed messages.
+
+        Only messages newer than high watermark are fetched, with `backfill`
+        messages older than low watermark are fetched too, whole history is
+        fetched while chat has no watermarks. With `window` only messages
+        between its ids are fetched and watermarks aren't changed.
+        """
+
+        checkpoint = await self._checkpoints.aget(self.request.id)
+
+        if checkpoint is not None:
+            logger.info(f"Resume messages parsing from checkpoint at {checkpoint['date']}.")
+
+            marks = {"low": checkpoint["low"], "high": checkpoint["high"]}
+            backfill = checkpoint["backfill"]
+        elif window is not None:
+            marks = {"low": window[0], "high": window[0]}
+            backfill = False
         else:
-            logger.info("Messages download success.")
+            marks = self._get_watermarks(chat)
+
+            if marks is None:
+                # Nothing is known to be parsed, whole history is walked
+                backfill = True
+
+        # Ids range of parsed messages, history inside it is complete
+        parsed = dict(marks) if marks is not None and (window is None or checkpoint is not None) else {}
+
+        async def handle(tg_message: 'telethon.types.Message'):
+            await self._handle_links(chat, tg_message.message)
+
+            await self._handle_message(client, chat, tg_message)
+
+        async def save_checkpoint(pool: 'utils.KeyedWorkerPool', buffer: 'utils.WriteBehindBuffer', threads: 'dict',
+                                  tg_message: 'telethon.types.Message'):
+            await pool.join()
+            await self._flush_threads(client, chat, threads)
+            await buffer.flush()
+
+            await self._checkpoints.aset(self.request.id, {
+                "low": parsed["low"],
+                "high": parsed["high"],
+                "backfill": backfill,
+                "date": tg_message.date.isoformat()
+            })
+
+        async def put(pool: 'utils.KeyedWorkerPool', buffer: 'utils.WriteBehindBuffer', threads: 'dict', **kwargs):
+            count = 0
+
+            async for tg_message in client.iter_messages(chat.internal_id, **kwargs):
+                if not isinstance(tg_message, telethon.types.Message):
+                    continue
+
+                await pool.put(self._get_message_key(tg_message), tg_message)
+
+                parsed["low"] = min(parsed.get("low", tg_message.id), tg_message.id)
+                parsed["high"] = max(parsed.get("high", tg_message.id), tg_message.id)
+
+                count += 1
+
+                if count % self.CHECKPOINT_INTERVAL == 0:
+                    await save_checkpoint(pool, buffer, threads, tg_message)
+
+        with self._collect_links(chat):
+            async with utils.WriteBehindBuffer() as buffer:
+                async with self._collect_threads(client, chat) as threads:
+                    async with utils.KeyedWorkerPool(handle, self.CONCURRENCY) as pool:
+                        if marks is None:
+                            await put(pool, buffer, threads)
+                        else:
+                            await put(pool, buffer, threads, min_id=marks["high"], max_id=window[1] if window else 0,
+                                      reverse=True)
+
+                            if backfill:
+                                await put(pool, buffer, threads, max_id=marks["low"])
+
+        if parsed and window is None:
+            await self._set_watermarks(chat, parsed)
+
+        await self._checkpoints.adelete(self.request.id)
+
+        logger.info("Messages download success.")
+
+        return parsed
+
+    async def _get_windows(self, chat: 'models.TypeChat', chat_phones: 'list[models.TypeChatPhone]',
+                           backfill: 'bool') -> 'tuple[dict | None, list[tuple[int, int]]]':
+        """Returns current watermarks and windows of messages ids left to parse"""
+
+        marks = self._get_watermarks(chat)
 
-    async def _run(self, chat: 'models.TypeChat', chat_phones: 'list[models.TypeChatPhone]'):
         for chat_phone in chat_phones:
-            phone = chat_phone.phone
+            phone = await chat_phone.phone.aresolve()
 
             if phone.takeout:
                 continue
 
             try:
                 async with utils.TelegramClient(phone) as client:
-                    while True:
-                        try:
-                            async with client.takeout(users=True, chats=True, megagroups=True, channels=True,
-                                                      files=True, max_file_size=2147483647) as takeout:
-                                await self._get_messages(takeout, chat)
-                        except telethon.errors.TakeoutInitDelayError as ex:
-                            logger.warning('Must wait', ex.seconds, 'before takeout')
+                    last_messages = await client.get_messages(chat.internal_id, limit=1)
+            except exceptions.UnauthorizedError as ex:
+                logger.critical(f"{ex}")
 
-                            await asyncio.sleep(ex.seconds)
+                continue
 
-                            continue
-                        except telethon.errors.TakeoutInvalidError as ex:
-                            logger.error(f"{ex}")
+            break
+        else:
+            return marks, []
 
-                            break
-                        else:
-                            return True
-            except exceptions.UnauthorizedError as ex:
-                logger.critical(f"{ex}")
+        if not last_messages:
+            return marks, []
 
-                chat_phone.is_using = False
-                chat_phone.save()
+        if marks is None:
+            ranges = [(0, last_messages[0].id + 1)]
+        else:
+            ranges = [(marks["high"], last_messages[0].id + 1)]
 
-                continue
+            if backfill:
+                ranges.append((0, marks["low"]))
+
+        return marks, [
+            (start, min(start + self.WINDOW_SIZE + 1, end))
+            for min_id, end in ranges
+            for start in range(min_id, end - 1, self.WINDOW_SIZE)
+        ]
+
+    async def _run(self, chat: 'models.TypeChat', chat_phones: 'list[models.TypeChatPhone]', backfill: 'bool',
+                   window: 'tuple[int, int] | None' = None):
+        chat_phones = await utils.TelegramClient.SCHEDULER.order(chat_phones, lambda chat_phone: chat_phone.phone,
+                                                                 rpc="GetHistoryRequest")
+        busy = False
+
+        for chat_phone in chat_phones:
+            phone = await chat_phone.phone.aresolve()
+
+            # Takeout is held by one task at a time, other phones are tried meanwhile
+            async with utils.TelegramClient.SCHEDULER.lease(phone.id) as leased:
+                if phone.takeout or not leased:
+                    busy = True
+
+                    continue
+
+                try:
+                    async with utils.TelegramClient(phone) as client:
+                        while True:
+                            try:
+                                async with client.takeout(users=True, chats=True, megagroups=True, channels=True,
+                                                          files=True, max_file_size=2147483647) as takeout:
+                                    parsed = await self._get_messages(takeout, chat, backfill, window)
+                            except (telethon.errors.TakeoutInitDelayError, telethon.errors.FloodWaitError) as ex:
+                                # Messages parsing resumes from checkpoint
+                                raise self._retry_later(ex)
+                            except telethon.errors.TakeoutInvalidError as ex:
+                                logger.error(f"{ex}")
+
+                                break
+                            else:
+                                return parsed
+                except exceptions.UnauthorizedError as ex:
+                    logger.critical(f"{ex}")
+
+                    chat_phone.is_using = False
+                    await chat_phone.asave()
+
+                    continue
+
+        if busy:
+            logger.warning(f"Chat phones are busy with other takeouts, task is retried in {self.BUSY_COUNTDOWN}.")
+
+            raise self.retry(countdown=self.BUSY_COUNTDOWN)
 
         raise Exception("Chat doesn't have available phones, try again later.")
 
-    def run(self, chat_id):
+    def run(self, chat_id, backfill=False):
         try:
             chat = models.Chat(id=chat_id).reload()
         except exceptions.RequestException as ex:
@@ -719,19 +1133,132 @@ class ParseMessagesTask(ParseBaseTask):
 
             raise Exception("Can't get chat wired phones.")
 
-        return asyncio.run(self._run(chat, chat_phones))
+        # Retried task resumes from its own checkpoint instead of fanning out again
+        if len(chat_phones) > 1 and self._checkpoints.get(self.request.id) is None:
+            marks, windows = self._run_async(self._get_windows(chat, chat_phones, backfill))
+
+            if len(windows) > 1:
+                lanes = min(len(chat_phones), len(windows))
+
+                logger.info(f"Messages are parsed in {len(windows)} windows by {lanes} phones.")
+
+                # Each phone parses its windows one by one, as takeout of phone can't be shared
+                lanes_windows = [
+                    [
+                        app.signature(ParseMessagesWindowTask.name, args=[chat.id, min_id, max_id, lane])
+                        for min_id, max_id in windows[lane::lanes]
+                    ] for lane in range(lanes)
+                ]
+
+                return self.replace(chord(
+                    [
+                        # Windows of lane pass list of parsed ranges to the next one, so the first starts it
+                        chain(signatures[0].clone(args=([],)), *signatures[1:])
+                        for signatures in lanes_windows
+                    ],
+                    app.signature(ParseMessagesMergeTask.name, args=[chat.id, marks, self.request.id]).on_error(
+                        app.signature(ParseMessagesFailureTask.name, args=[self.request.id])
+                    )
+                ))
+
+        self._run_async(self._run(chat, chat_phones, backfill))
+
+        return True
 
 
 app.register_task(ParseMessagesTask())
 
 
+class ParseMessagesWindowTask(ParseMessagesTask):
+    name = "ParseMessagesWindowTask"
+    queue = "low_prio"
+
+    @staticmethod
+    def before_start(task_id, args, kwargs):
+        """Window is tracked by 'ChatTask' of the task which has fanned it out"""
+
+    @staticmethod
+    def on_success(retval, task_id, args, kwargs):
+        """Window is tracked by 'ChatTask' of the task which has fanned it out"""
+
+    @staticmethod
+    def on_failure(exc, task_id, args, kwargs, einfo):
+        """Window is tracked by 'ChatTask' of the task which has fanned it out"""
+
+    def run(self, parsed, chat_id, min_id, max_id, lane):
+        """Parse window after previous windows of lane, returns their parsed ranges with its own"""
+
+        try:
+            chat = models.Chat(id=chat_id).reload()
+        except exceptions.RequestException as ex:
+            logger.error(f"{ex}")
+
+            raise Exception("Can't find given chat.")
+
+        try:
+            chat_phones = models.ChatPhone.find(chat=chat.id, is_using=True)
+        except exceptions.RequestException as ex:
+            logger.error(f"{ex}")
+
+            raise Exception("Can't get chat wired phones.")
+
+        # Lanes start from different phones, others are used if it's unavailable
+        lane %= max(1, len(chat_phones))
+        chat_phones = chat_phones[lane:] + chat_phones[:lane]
+
+        return parsed + [self._run_async(self._run(chat, chat_phones, False, (min_id, max_id)))]
+
+
+app.register_task(ParseMessagesWindowTask())
+
+
+class ParseMessagesMergeTask(Task):
+    name = "ParseMessagesMergeTask"
+    queue = "low_prio"
+
+    def run(self, results, chat_id, marks, task_id):
+        ranges = [result for lane in results for result in lane if result]
+
+        if marks is not None:
+            ranges.append(marks)
+
+        if ranges:
+            chat = models.Chat(id=chat_id).reload()
+
+            chat.low_watermark = min(result["low"] for result in ranges)
+            chat.high_watermark = max(result["high"] for result in ranges)
+            chat.save()
+
+        ParseBaseTask.on_success(True, task_id, None, None)
+
+        return True
+
+
+app.register_task(ParseMessagesMergeTask())
+
+
+class ParseMessagesFailureTask(Task):
+    name = "ParseMessagesFailureTask"
+    queue = "low_prio"
+
+    def run(self, failed_task_id, task_id):
+        ParseBaseTask.on_failure(app.AsyncResult(failed_task_id).result, task_id, None, None, None)
+
+        return True
+
+
+app.register_task(ParseMessagesFailureTask())
+
+
 class MonitoringChatTask(ParseBaseTask):
     name = "MonitoringChatTask"
     queue = "high_prio"
 
     async def _run(self, chat: 'models.TypeChat', chat_phones: 'list[models.TypeChatPhone]'):
+        chat_phones = await utils.TelegramClient.SCHEDULER.order(chat_phones, lambda chat_phone: chat_phone.phone)
+
         for chat_phone in chat_phones:
-            phone = chat_phone.phone
+            phone = await chat_phone.phone.aresolve()
 
             try:
                 async with utils.TelegramClient(phone) as client:
@@ -746,7 +1273,7 @@ class MonitoringChatTask(ParseBaseTask):
                         if not isinstance(event.message, telethon.types.Message):
                             return
 
-                        await self._handle_links(client, event.message.message)
+                        await self._handle_links(chat, event.message.message)
 
                         await self._handle_message(client, chat, event.message)
 
@@ -757,7 +1284,7 @@ class MonitoringChatTask(ParseBaseTask):
                 logger.critical(f"{ex}")
 
                 chat_phone.is_using = False
-                chat_phone.save()
+                await chat_phone.asave()
 
                 continue
 
@@ -778,7 +1305,199 @@ class MonitoringChatTask(ParseBaseTask):
 
             raise Exception("Can't get chat wired phones.")
 
-        return asyncio.run(self._run(chat, chat_phones))
+        return self._run_async(self._run(chat, chat_phones))
 
 
 app.register_task(MonitoringChatTask())
+
+
+class ResolveLinksTask(ParseBaseTask):
+    name = "ResolveLinksTask"
+    queue = "links"
+
+    PHONE_BUDGET = int(os.environ.get('CELERY_LINKS_PHONE_BUDGET', 20))
+    RETRY_COUNTDOWN = int(os.environ.get('CELERY_LINKS_RETRY_COUNTDOWN', 600))
+    MAX_RETRIES = int(os.environ.get('CELERY_LINKS_MAX_RETRIES', 6))
+
+    @staticmethod
+    def before_start(task_id, args, kwargs):
+        """Links resolving isn't tracked by 'ChatTask'"""
+
+    @staticmethod
+    def on_success(retval, task_id, args, kwargs):
+        """Links resolving isn't tracked by 'ChatTask'"""
+
+    @staticmethod
+    def on_failure(exc, task_id, args, kwargs, einfo):
+        """Links resolving isn't tracked by 'ChatTask'"""
+
+    async def _run(self, links: 'list[str]', phones: 'list[models.TypePhone]'):
+        phones = await utils.TelegramClient.SCHEDULER.order(phones, rpc="ResolveUsernameRequest")
+
+        for phone in phones:
+            if not links:
+                break
+
+            try:
+                async with utils.TelegramClient(phone) as client:
+                    budget = self.PHONE_BUDGET
+
+                    while links and budget > 0:
+                        username, _ = utils.parse_username(links[0])
+
+                        if await self._links.aget(username) is not None:
+                            links.pop(0)
+
+                            continue
+
+                        budget -= 1
+
+                        if not await self._resolve_link(client, username, links[0]):
+                            break
+
+                        links.pop(0)
+            except exceptions.UnauthorizedError as ex:
+                logger.critical(f"{ex}")
+
+                continue
+
+        return links
+
+    def run(self, links: 'list[str]', parser_id: 'str'):
+        try:
+            phones = self._find_phones(parser_id)
+        except exceptions.RequestException as ex:
+            logger.error(f"{ex}")
+
+            raise Exception("Can't get phones.")
+
+        left = self._run_async(self._run(list(links), phones))
+
+        if left and self.request.retries < self.MAX_RETRIES:
+            logger.info(f"{len(left)} links are left unresolved, postponed for {self.RETRY_COUNTDOWN} seconds.")
+
+            raise self.retry(args=[left, parser_id], countdown=self.RETRY_COUNTDOWN, max_retries=self.MAX_RETRIES)
+
+        if left:
+            logger.warning(f"{len(left)} links are left unresolved after {self.request.retries} retries, dropped.")
+
+        return len(links) - len(left)
+
+
+app.register_task(ResolveLinksTask())
+
+
+class DownloadMediaTask(Task):
+    name = "DownloadMediaTask"
+    queue = "media"
+
+    MEDIA_TYPES = ("ChatMedia", "MemberMedia", "MessageMedia")
+
+    @staticmethod
+    async def _get_file_reference(client, media: 'models.TypeEntity', loc) -> 'bytes | None':
+        """Returns fresh file reference of media location or `None` if its file isn't available anymore"""
+
+        if isinstance(media, models.MessageMedia):
+            message = await media.message.aresolve()
+            chat = await message.chat.aresolve()
+
+            tg_message = await client.get_messages(chat.internal_id, ids=message.internal_id)
+
+            if tg_message is None:
+                return None
+
+            if isinstance(tg_message.media, telethon.types.MessageMediaPhoto):
+                files = [tg_message.media.photo]
+            elif isinstance(tg_message.media, telethon.types.MessageMediaDocument):
+                files = [tg_message.media.document]
+            else:
+                return None
+        else:
+            if isinstance(media, models.ChatMedia):
+                owner = (await media.chat.aresolve()).internal_id
+            else:
+                owner = (await media.member.aresolve()).internal_id
+
+            files = [photo async for photo in client.iter_profile_photos(owner)]
+
+        for file in files:
+            if file.id == loc.id:
+                return file.file_reference
+
+        return None
+
+    async def _run(self, phone: 'models.TypePhone', media: 'models.TypeEntity', loc, file_size: 'int',
+                   extension: 'str'):
+        async with utils.TelegramClient(phone) as client:
+            try:
+                try:
+                    await client.download_media(media, loc, file_size, extension)
+                except (
+                    telethon.errors.FileReferenceExpiredError,
+                    telethon.errors.FileReferenceInvalidError
+                ) as ex:
+                    file_reference = await self._get_file_reference(client, media, loc)
+
+                    if file_reference is None:
+                        raise ex
+
+                    # Job may wait in queue longer than file reference lives, it's retried once with fresh one
+                    logger.warning(f"File reference of media {media.id} is refreshed. Exception {ex}")
+
+                    loc.file_reference = file_reference
+
+                    await client.download_media(media, loc, file_size, extension)
+
+                await media.areload()
+
+                if media.path is not None:
+                    await self._stored_media.aset(utils.location_key(loc), media.path)
+            except telethon.errors.FloodWaitError as ex:
+                raise self._retry_later(ex)
+            except (
+                telethon.errors.FileReferenceExpiredError,
+                telethon.errors.FileReferenceInvalidError
+            ) as ex:
+                logger.error(f"Media {media.id} can't be downloaded. Exception {ex}")
+
+                return False
+
+        return True
+
+    def run(self, phone_id: 'str', media_type: 'str', media_id: 'str', location: 'dict', file_size: 'int',
+            extension: 'str'):
+        if media_type not in self.MEDIA_TYPES:
+            raise Exception(f"Unknown media type {media_type}.")
+
+        try:
+            media = getattr(models, media_type)(id=media_id).reload()
+        except exceptions.RequestException as ex:
+            logger.error(f"{ex}")
+
+            raise Exception("Can't get given media.")
+
+        if media.path is not None:
+            return True
+
+        loc = utils.load_location(location)
+
+        # Same file may have been stored for another chat since the job was sent
+        path = self._stored_media.get(utils.location_key(loc))
+
+        if path is not None:
+            media.path = path
+            media.save()
+
+            return True
+
+        try:
+            phone = models.Phone(id=phone_id).reload()
+        except exceptions.RequestException as ex:
+            logger.error(f"{ex}")
+
+            raise Exception("Can't get given phone.")
+
+        return self._run_async(self._run(phone, media, loc, file_size, extension))
+
+
+app.register_task(DownloadMediaTask())
@@ -1,8 +1,12 @@
 """Collection of entity representations"""
 import sys
+import collections
+import contextvars
+import hashlib
+import json
 from abc import ABCMeta, abstractmethod
 from typing import Generic, TypeVar
-from .utils import ApiService
+from .utils import ApiService, WriteBehindBuffer
 
 
 class RelatedProperty(property):
@@ -20,18 +24,10 @@ class RelatedProperty(property):
         return self._cls
 
     def __get__(self, instance, owner=None):
-        value = getattr(instance, f"{self.name}_id", None)
-        value = self.cls(id=value)
-
-        try:
-            return value.reload()
-        except ValueError:
-            pass
-
-        return value
+        return RelatedEntity(self.cls, getattr(instance, f"{self.name}_id", None))
 
     def __set__(self, instance, value):
-        if isinstance(value, self.cls):
+        if isinstance(value, (self.cls, RelatedEntity)):
             value = value.id
         elif isinstance(value, (str, type(None))):
             value = value
@@ -46,6 +42,87 @@ class RelatedProperty(property):
         setattr(instance, f"{self.name}_id", value)
 
 
+class RelatedEntity:
+    """
+    Lazy proxy of related entity.
+
+    Answers `id` locally and fetches entity from `IdentityMap` or API
+    only on first access of any other attribute.
+    """
+
+    __slots__ = ("_cls", "_id", "_entity")
+
+    def __init__(self, cls: 'type[TypeEntity]', id: 'str | None'):
+        object.__setattr__(self, "_cls", cls)
+        object.__setattr__(self, "_id", id)
+        object.__setattr__(self, "_entity", None)
+
+    def __repr__(self):
+        return f"<{self._cls.__name__} proxy ({self._id})>"
+
+    def __eq__(self, other):
+        if not isinstance(other, (Entity, RelatedEntity)):
+            return False
+
+        if self._id is None:
+            return self is other
+
+        return self._id == other.id
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resolve(), name, value)
+
+    @property
+    def id(self) -> 'str | None':
+        return self._id
+
+    @property
+    def _endpoint(self) -> 'str':
+        return self._cls._endpoint
+
+    def _lookup(self) -> 'TypeEntity | None':
+        if self._entity is None:
+            identity_map = IdentityMap.current()
+
+            if identity_map is not None and self._id is not None:
+                object.__setattr__(self, "_entity", identity_map.get(self._cls, self._id))
+
+        return self._entity
+
+    def resolve(self) -> 'TypeEntity':
+        """Returns related entity, fetching it from API if needed"""
+
+        if self._lookup() is None:
+            entity = self._cls(id=self._id)
+
+            try:
+                entity.reload()
+            except ValueError:
+                pass
+
+            object.__setattr__(self, "_entity", entity)
+
+        return self._entity
+
+    async def aresolve(self) -> 'TypeEntity':
+        """Returns related entity, fetching it from API asynchronously if needed"""
+
+        if self._lookup() is None:
+            entity = self._cls(id=self._id)
+
+            try:
+                await entity.areload()
+            except ValueError:
+                pass
+
+            object.__setattr__(self, "_entity", entity)
+
+        return self._entity
+
+
 T = TypeVar('T', bound='Entity')
 
 
@@ -53,6 +130,7 @@ class Entity(Generic[T], metaclass=ABCMeta):
     """Base class for entities"""
 
     id = None
+    _pending = None
 
     def __init__(self, **kwargs):
         self.deserialize(**kwargs)
@@ -61,7 +139,7 @@ class Entity(Generic[T], metaclass=ABCMeta):
         return f"<{self} object ({self.id})>"
 
     def __eq__(self, other):
-        if not isinstance(other, Entity):
+        if not isinstance(other, (Entity, RelatedEntity)):
             return False
 
         my_id = self.id
@@ -90,13 +168,31 @@ class Entity(Generic[T], metaclass=ABCMeta):
 
         raise NotImplementedError
 
+    def fingerprint(self) -> 'str':
+        """Хеш сериализованных полей сущности без `id`, меняется только при изменении содержимого"""
+
+        data = self.serialize()
+        data.pop("id", None)
+
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _identify(self) -> 'T':
+        """Регистрирует сущность в текущей `IdentityMap`."""
+
+        identity_map = IdentityMap.current()
+
+        if identity_map is not None:
+            identity_map.add(self)
+
+        return self
+
     @classmethod
     def find(cls, **kwargs) -> 'list[T]':
         """Возвращает отфильтрованный и отсортированный список сущностей"""
 
         entities = ApiService().get(cls._endpoint, **kwargs)
 
-        return [cls(**entity) for entity in entities["results"]]
+        return [cls(**entity)._identify() for entity in entities["results"]]
 
     def reload(self) -> 'T':
         """Обновляет текущую сущность из API."""
@@ -108,7 +204,7 @@ class Entity(Generic[T], metaclass=ABCMeta):
 
         self.deserialize(**entity)
 
-        return self
+        return self._identify()
 
     def save(self) -> 'T':
         """Создает/изменяет сущность в API."""
@@ -117,7 +213,7 @@ class Entity(Generic[T], metaclass=ABCMeta):
 
         self.deserialize(**entity)
 
-        return self
+        return self._identify()
 
     def delete(self) -> 'None':
         """
@@ -126,6 +222,160 @@ class Entity(Generic[T], metaclass=ABCMeta):
 
         ApiService().delete(self.__class__._endpoint, self.id)
 
+    @classmethod
+    async def afind(cls, **kwargs) -> 'list[T]':
+        """Асинхронно возвращает отфильтрованный и отсортированный список сущностей"""
+
+        entities = await ApiService().aget(cls._endpoint, **kwargs)
+
+        return [cls(**entity)._identify() for entity in entities["results"]]
+
+    async def areload(self) -> 'T':
+        """Асинхронно обновляет текущую сущность из API."""
+
+        if not self.id:
+            raise ValueError("Entity hasn't id")
+
+        entity = await ApiService().aget(self.__class__._endpoint, id=self.id, force=True)
+
+        self.deserialize(**entity)
+
+        return self._identify()
+
+    async def asave(self, defer: 'bool' = False) -> 'T':
+        """
+        Асинхронно создает/изменяет сущность в API.
+
+        С `defer=True` создание новой сущности откладывается в открытый `WriteBehindBuffer`,
+        `id` будет заполнен после сброса буфера (см. `Entity.flushed`).
+        """
+
+        buffer = WriteBehindBuffer.current()
+
+        if defer and buffer is not None and self.id is None:
+            self._pending = await buffer.add(self)
+
+            return self
+
+        entity = await ApiService().aset(self.__class__._endpoint, **self.serialize())
+
+        self.deserialize(**entity)
+
+        return self._identify()
+
+    async def flushed(self) -> 'T':
+        """Дожидается сохранения отложенной сущности, сбрасывая буфер при необходимости."""
+
+        if self._pending is not None:
+            buffer = WriteBehindBuffer.current()
+
+            if buffer is not None and not self._pending.done():
+                await buffer.flush(self.__class__._endpoint)
+
+            await self._pending
+
+            self._pending = None
+
+        return self._identify()
+
+    async def adelete(self) -> 'None':
+        """
+        Асинхронно удаляет сущность из API.
+        """
+
+        await ApiService().adelete(self.__class__._endpoint, self.id)
+
+
+class IdentityMap:
+    """
+    Task scoped map of materialized entities.
+
+    Each (endpoint, id) pair is materialized once per map, so repeated traversals
+    of `RelatedProperty` are served from memory instead of API.
+    """
+
+    _current: 'contextvars.ContextVar[IdentityMap | None]' = contextvars.ContextVar("identity_map", default=None)
+
+    def __init__(self, max_size: 'int' = 10000):
+        self.max_size = max_size
+
+        self._entities: 'collections.OrderedDict[tuple[str, str], TypeEntity]' = collections.OrderedDict()
+        self._token = None
+
+    @classmethod
+    def current(cls) -> 'IdentityMap | None':
+        """Returns identity map opened in current context"""
+
+        return cls._current.get()
+
+    def __enter__(self):
+        self._token = self._current.set(self)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._current.reset(self._token)
+
+        self.clear()
+
+    def get(self, cls: 'type[TypeEntity]', id: 'str') -> 'TypeEntity | None':
+        """Returns materialized entity"""
+
+        entity = self._entities.get((cls._endpoint, id))
+
+        if entity is not None:
+            self._entities.move_to_end((cls._endpoint, id))
+
+        return entity
+
+    def add(self, entity: 'TypeEntity') -> 'TypeEntity':
+        """Registers materialized entity"""
+
+        if entity.id is None:
+            return entity
+
+        self._entities[(entity._endpoint, entity.id)] = entity
+        self._entities.move_to_end((entity._endpoint, entity.id))
+
+        while len(self._entities) > self.max_size:
+            self._entities.popitem(last=False)
+
+        return entity
+
+    def remove(self, entity: 'TypeEntity') -> 'None':
+        """Forgets entity, so next traversal will fetch it from API"""
+
+        self._entities.pop((entity._endpoint, entity.id), None)
+
+    def clear(self) -> 'None':
+        """Forgets all entities"""
+
+        self._entities.clear()
+
+    def refresh(self, entity: 'TypeEntity' = None) -> 'TypeEntity | None':
+        """Reloads entity from API, or forgets all entities if it isn't given"""
+
+        if entity is None:
+            return self.clear()
+
+        return entity.reload()
+
+    async def arefresh(self, entity: 'TypeEntity' = None) -> 'TypeEntity | None':
+        """Reloads entity from API asynchronously, or forgets all entities if it isn't given"""
+
+        if entity is None:
+            return self.clear()
+
+        return await entity.areload()
+
+    async def flush(self) -> 'None':
+        """Sends deferred creations of current `WriteBehindBuffer` to API"""
+
+        buffer = WriteBehindBuffer.current()
+
+        if buffer is not None:
+            await buffer.flush()
+
 
 class Host(Entity['Host']):
     """Host entity representation"""
@@ -204,6 +454,8 @@ class Chat(Entity['Chat']):
     date: 'str' = None
     total_members: 'int' = None
     total_messages: 'int' = None
+    low_watermark: 'int' = None
+    high_watermark: 'int' = None
     parser: 'TypeParser' = RelatedProperty("parser", Parser)
 
     def serialize(self) -> 'dict':
@@ -218,6 +470,8 @@ class Chat(Entity['Chat']):
             "date": self.date,
             "total_members": self.total_members,
             "total_messages": self.total_messages,
+            "low_watermark": self.low_watermark,
+            "high_watermark": self.high_watermark,
             "parser": self.parser.id
         }
 
@@ -232,6 +486,8 @@ class Chat(Entity['Chat']):
         self.date = kwargs.get('date')
         self.total_members = kwargs.get('total_members')
         self.total_messages = kwargs.get('total_messages')
+        self.low_watermark = kwargs.get('low_watermark')
+        self.high_watermark = kwargs.get('high_watermark')
         self.parser = kwargs.get('parser')
 
         return self
@@ -333,6 +589,7 @@ class Phone(Entity['Phone']):
     parser: 'TypeParser' = RelatedProperty("parser", Parser)
     api: 'dict' = None
     takeout: 'bool' = False
+    floods: 'dict' = None
 
     def serialize(self) -> 'dict':
         return {
@@ -348,7 +605,8 @@ class Phone(Entity['Phone']):
             "code": self.code,
             "parser": self.parser.id,
             "api": self.api,
-            "takeout": self.takeout
+            "takeout": self.takeout,
+            "floods": self.floods
         }
 
     def deserialize(self, **kwargs) -> 'TypePhone':
@@ -365,6 +623,7 @@ class Phone(Entity['Phone']):
         self.code = kwargs.get("code")
         self.api = kwargs.get("api")
         self.takeout = kwargs.get("takeout", False)
+        self.floods = kwargs.get("floods")
 
         return self
 
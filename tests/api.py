@@ -0,0 +1,74 @@
+"""Local stand-in of API for tests"""
+import os
+import uuid
+from aiohttp import web
+
+
+class StandInApi:
+    """
+    In-memory API serving entity creations one by one and in bulk.
+
+    Serves `POST {endpoint}/` and `POST {endpoint}/bulk/` on a free local port.
+    Every request is recorded in `requests`, endpoints in `failing` answer with 500.
+    """
+
+    def __init__(self):
+        self.entities: 'dict[str, dict[str, dict]]' = {}
+        self.requests: 'list[tuple[str, str, int]]' = []
+        self.failing: 'set[str]' = set()
+
+        self._runner: 'web.AppRunner | None' = None
+
+    def _store(self, endpoint: 'str', body: 'dict') -> 'dict':
+        body["id"] = str(uuid.uuid4())
+
+        self.entities.setdefault(endpoint, {})[body["id"]] = body
+
+        return body
+
+    async def _create(self, request: 'web.Request') -> 'web.Response':
+        endpoint = request.match_info["endpoint"]
+        body = await request.json()
+
+        self.requests.append((request.path, endpoint, 1))
+
+        if endpoint in self.failing:
+            return web.Response(status=500, text="Stand-in failure")
+
+        return web.json_response(self._store(endpoint, body), status=201)
+
+    async def _bulk(self, request: 'web.Request') -> 'web.Response':
+        endpoint = request.match_info["endpoint"]
+        items = await request.json()
+
+        self.requests.append((request.path, endpoint, len(items)))
+
+        if endpoint in self.failing:
+            return web.Response(status=500, text="Stand-in failure")
+
+        return web.json_response([self._store(endpoint, item) for item in items], status=201)
+
+    async def __aenter__(self) -> 'StandInApi':
+        app = web.Application()
+        app.router.add_post("/{endpoint}/", self._create)
+        app.router.add_post("/{endpoint}/bulk/", self._bulk)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+
+        os.environ['CELERY_API_URL'] = f"http://127.0.0.1:{port}"
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._runner.cleanup()
+
+    def bulks(self, endpoint: 'str') -> 'list[int]':
+        """Returns sizes of bulk requests sent to endpoint"""
+
+        return [size for path, name, size in self.requests if name == endpoint and path.endswith("/bulk/")]
@@ -0,0 +1,32 @@
+"""Imports the package from its checkout directory with test settings"""
+import importlib
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('CELERY_BROKER', "memory://")
+os.environ.setdefault('CELERY_RESULT_BACKEND', "cache+memory://")
+os.environ.setdefault('CELERY_TIMEZONE', "UTC")
+os.environ.setdefault('CELERY_ENABLE_UTC', "false")
+os.environ.setdefault('CELERY_API_URL', "http://127.0.0.1:1")
+
+sys.path.insert(0, os.path.dirname(ROOT))
+
+package = importlib.import_module(os.path.basename(ROOT))
+
+
+@pytest.fixture
+def utils(monkeypatch):
+    # API URL is set by stand-in API, bulk support is detected again by every test
+    monkeypatch.setenv('CELERY_API_URL', os.environ['CELERY_API_URL'])
+    monkeypatch.setattr(package.utils.ApiService, "_no_bulk", set())
+    monkeypatch.setattr(package.utils.ApiService, "_cache", package.utils.Cache())
+
+    return package.utils
+
+
+@pytest.fixture
+def models():
+    return package.models
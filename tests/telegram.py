@@ -0,0 +1,70 @@
+"""Local stand-ins of telegram for tests"""
+import asyncio
+import telethon
+from telethon import types
+from conftest import package
+
+
+class CappedParticipantsClient:
+    """
+    Client of channel which members search returns at most `cap` members per query.
+
+    Members match query if any word of their name starts with it, like in telegram.
+    Queries of sent search requests are recorded in `searches`.
+    """
+
+    PARTICIPANTS_PARALLEL = 4
+
+    iter_participants = package.utils.TelegramClient.iter_participants
+    _TelegramClient__ParticipantsIter = package.utils.TelegramClient._TelegramClient__ParticipantsIter
+
+    def __init__(self, names: 'list[str]', cap: 'int' = 200, depth: 'int' = 3):
+        self.users = [types.User(id=i + 1, first_name=name) for i, name in enumerate(names)]
+        self.cap = cap
+        self.MEMBERS_SEARCH_DEPTH = depth
+        self.flood_sleep_threshold = 60
+
+        self.searches: 'list[str]' = []
+
+    async def get_input_entity(self, entity):
+        return types.InputPeerChannel(channel_id=1, access_hash=0)
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        if isinstance(request.filter, types.ChannelParticipantsSearch):
+            self.searches.append(request.filter.q)
+
+            matched = [
+                user for user in self.users
+                if any(word.startswith(request.filter.q) for word in user.first_name.split())
+            ]
+        else:
+            matched = self.users
+
+        users = matched[:self.cap][request.offset:request.offset + request.limit]
+
+        return types.channels.ChannelParticipants(
+            count=len(matched),
+            participants=[types.ChannelParticipant(user_id=user.id, date=None) for user in users],
+            chats=[],
+            users=users
+        )
+
+
+class FloodSender:
+    """Sender answering first requests with flood waits of given seconds, then with `True`"""
+
+    def __init__(self, *floods: 'int'):
+        self.floods = list(floods)
+        self.sent = 0
+
+    def send(self, request, ordered=False):
+        future = asyncio.get_running_loop().create_future()
+
+        self.sent += 1
+
+        if self.floods:
+            future.set_exception(telethon.errors.FloodWaitError(request=request, capture=self.floods.pop(0)))
+        else:
+            future.set_result(True)
+
+        return future
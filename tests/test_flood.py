@@ -0,0 +1,84 @@
+import time
+import pytest
+from telethon import functions
+from opentele.api import API
+from conftest import package
+from telegram import FloodSender
+
+
+def run(coro):
+    return package.Task._run_async(coro)
+
+
+@pytest.fixture
+def phone(monkeypatch, tmp_path, models):
+    monkeypatch.setenv('CELERY_SESSIONS_DIR', str(tmp_path))
+    monkeypatch.setattr(package.utils.TelegramClient.LIMITER, "_floods", {})
+
+    api = API.TelegramDesktop.Generate().__dict__
+    del api["pid"]
+
+    return models.Phone(id="phone", api=api)
+
+
+@pytest.fixture
+def floods(monkeypatch):
+    """Phone floods recorded by scheduler"""
+
+    floods = []
+
+    async def flood(phone, rpc, seconds):
+        floods.append((rpc, seconds))
+
+    monkeypatch.setattr(package.utils.TelegramClient.SCHEDULER, "flood", flood)
+
+    return floods
+
+
+def test_short_flood_wait_is_shared_and_slept(phone):
+    sender = FloodSender(1)
+
+    async def scenario():
+        client = package.utils.TelegramClient(phone)
+        started = time.monotonic()
+
+        assert await client._call(sender, functions.help.GetConfigRequest()) is True
+        assert time.monotonic() - started >= 1
+        assert client.flood_sleep_threshold == 60
+
+    run(scenario())
+
+    limiter = package.utils.TelegramClient.LIMITER
+
+    assert sender.sent == 2
+    assert limiter._key("flood", "phone", "GetConfigRequest") in limiter._floods
+
+
+def test_flood_wait_over_threshold_is_raised(phone, floods):
+    async def scenario():
+        client = package.utils.TelegramClient(phone)
+
+        with pytest.raises(package.utils.telethon.errors.FloodWaitError):
+            await client._call(FloodSender(100), functions.help.GetConfigRequest())
+
+        assert client.flood_sleep_threshold == 60
+
+    run(scenario())
+
+    assert floods == [("GetConfigRequest", 100)]
+
+
+def test_call_threshold_is_passed_to_client(phone, floods):
+    sender = FloodSender(1)
+
+    async def scenario():
+        client = package.utils.TelegramClient(phone)
+        client._sender = sender
+
+        with pytest.raises(package.utils.telethon.errors.FloodWaitError):
+            await client(functions.help.GetConfigRequest(), flood_sleep_threshold=0)
+
+    run(scenario())
+
+    assert sender.sent == 1
+    assert floods == [("GetConfigRequest", 1)]
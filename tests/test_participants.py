@@ -0,0 +1,76 @@
+import asyncio
+import itertools
+import pytest
+from conftest import package
+from telegram import CappedParticipantsClient
+
+
+def run(coro):
+    return package.Task._run_async(coro)
+
+
+def names(alphabet: 'str', length: 'int', count: 'int') -> 'list[str]':
+    prefixes = ["".join(prefix) for prefix in itertools.product(alphabet, repeat=length)]
+
+    return [f"{prefixes[i % len(prefixes)]}{i}" for i in range(count)]
+
+
+async def search(client: 'CappedParticipantsClient', adaptive: 'bool') -> 'set[int]':
+    return {user.id async for user in client.iter_participants(1, search="ab", aggressive=True, adaptive=adaptive)}
+
+
+def test_adaptive_search_expands_saturated_prefixes():
+    client = CappedParticipantsClient(names("ab", 3, 1000), cap=200, depth=3)
+
+    assert len(run(search(client, adaptive=True))) == 1000
+    assert max(len(q) for q in client.searches) == 3
+
+
+def test_adaptive_search_continues_after_seen_members():
+    # Second page of "b" has only members already found by "a"
+    client = CappedParticipantsClient(["b"] * 200 + ["a b"] * 200 + ["b"] * 50, cap=1000, depth=1)
+
+    assert len(run(search(client, adaptive=True))) == 450
+
+
+def test_search_without_adaptive_is_capped():
+    client = CappedParticipantsClient(names("ab", 3, 1000), cap=200, depth=3)
+
+    assert len(run(search(client, adaptive=False))) == 400
+    assert set(client.searches) == {"a", "b"}
+
+
+class FloodedClient(CappedParticipantsClient):
+    """Client answering search of "a" with long flood wait while other searches hang"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.cancelled: 'list[str]' = []
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        if not isinstance(request.filter, package.utils.types.ChannelParticipantsSearch):
+            return await super().__call__(request)
+
+        if request.filter.q == "a":
+            raise package.utils.telethon.errors.FloodWaitError(request=request, capture=100)
+
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            self.cancelled.append(request.filter.q)
+
+            raise
+
+
+def test_long_flood_wait_cancels_other_requests():
+    client = FloodedClient(names("ab", 1, 10))
+
+    async def scenario():
+        with pytest.raises(package.utils.telethon.errors.FloodWaitError):
+            await search(client, adaptive=True)
+
+        # Not left running until the loop is closed
+        assert client.cancelled == ["b"]
+
+    run(scenario())
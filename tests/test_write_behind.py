@@ -0,0 +1,92 @@
+import asyncio
+import pytest
+from api import StandInApi
+from conftest import package
+
+
+def run(coro):
+    return package.Task._run_async(coro)
+
+
+def test_flush_on_size(utils, models):
+    async def scenario():
+        async with StandInApi() as api:
+            async with utils.WriteBehindBuffer(max_size=3, max_age=60):
+                messages = [await models.Message(internal_id=i).asave(defer=True) for i in range(5)]
+
+                assert [message.id is not None for message in messages] == [True] * 3 + [False] * 2
+                assert api.bulks("messages") == [3]
+
+            assert all(message.id is not None for message in messages)
+            assert api.bulks("messages") == [3, 2]
+            assert len(api.entities["messages"]) == 5
+
+    run(scenario())
+
+
+def test_flush_on_age(utils, models):
+    async def scenario():
+        async with StandInApi() as api:
+            async with utils.WriteBehindBuffer(max_size=100, max_age=0.2):
+                message = await models.Message(internal_id=1).asave(defer=True)
+
+                assert message.id is None
+
+                await asyncio.sleep(0.5)
+
+                assert message.id is not None
+                assert api.bulks("messages") == [1]
+
+    run(scenario())
+
+
+def test_flush_on_exit(utils, models):
+    async def scenario():
+        async with StandInApi() as api:
+            async with utils.WriteBehindBuffer(max_size=100, max_age=60):
+                messages = [await models.Message(internal_id=i).asave(defer=True) for i in range(3)]
+
+            assert all(message.id is not None for message in messages)
+            assert api.bulks("messages") == [3]
+
+    run(scenario())
+
+
+def test_flush_on_error_raised_on_exit(utils, models):
+    async def scenario():
+        async with StandInApi() as api:
+            api.failing.add("messages")
+
+            with pytest.raises(package.exceptions.RequestException):
+                async with utils.WriteBehindBuffer(max_size=100, max_age=0.2):
+                    message = await models.Message(internal_id=1).asave(defer=True)
+
+                    await asyncio.sleep(0.5)
+
+            with pytest.raises(package.exceptions.RequestException):
+                await message.flushed()
+
+    run(scenario())
+
+
+def test_flush_on_error_raised_by_next_add(utils, models):
+    async def scenario():
+        async with StandInApi() as api:
+            api.failing.add("messages")
+
+            with pytest.raises(package.exceptions.RequestException):
+                async with utils.WriteBehindBuffer(max_size=100, max_age=0.2):
+                    message = await models.Message(internal_id=1).asave(defer=True)
+
+                    await asyncio.sleep(0.5)
+
+                    api.failing.clear()
+
+                    await models.Message(internal_id=2).asave(defer=True)
+
+            with pytest.raises(package.exceptions.RequestException):
+                await message.flushed()
+
+            assert "messages" not in api.entities
+
+    run(scenario())
@@ -1,23 +1,39 @@
 """Utilities for tasks"""
 import asyncio
+import collections
+import contextlib
+import contextvars
+import json
+import mmap
 import os
 import random
 import re
 import math
+import sqlite3
+import time
+import typing
 import names
 import urllib.parse
 import requests
+import aiohttp
+import redis
+import redis.asyncio
 import telethon
 from opentele.tl import TelegramClient as OpenteleClient
 from opentele.api import API, APIData
 from telethon import types, functions, hints
 from telethon.sessions import StringSession
+from telethon.tl.tlobject import TLRequest
 from telethon.client import downloads
 from telethon.client.chats import _ParticipantsIter, _MAX_PARTICIPANTS_CHUNK_SIZE
 from telethon.client.account import _TakeoutClient as _TelethonTakeoutClient
+from celery.utils.log import get_task_logger
 from . import models, exceptions, utils
 
 
+logger = get_task_logger(__name__)
+
+
 class Singleton(type):
     """Metaclass for singletone pattern representation"""
 
@@ -41,7 +57,7 @@ class _TakeoutClient(_TelethonTakeoutClient):
                              "takeout for the current session still not been finished yet.")
 
         client.phone.takeout = True
-        client.phone.save()
+        await client.phone.asave()
 
         return self
 
@@ -60,7 +76,620 @@ class _TakeoutClient(_TelethonTakeoutClient):
             self.session.takeout_id = None
 
         client.phone.takeout = False
-        client.phone.save()
+        await client.phone.asave()
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        takeout_id = self.__client.session.takeout_id
+
+        if takeout_id is None:
+            raise ValueError('Takeout mode has not been initialized (are you calling outside of "with"?)')
+
+        single = not telethon.utils.is_list_like(request)
+        requests = ((request,) if single else request)
+        wrapped = []
+
+        for r in requests:
+            if not isinstance(r, TLRequest):
+                raise TypeError('You can only invoke requests, not types!')
+
+            await r.resolve(self, telethon.utils)
+            wrapped.append(functions.InvokeWithTakeoutRequest(takeout_id, r))
+
+        return await self.__client(wrapped[0] if single else wrapped, ordered=ordered,
+                                   flood_sleep_threshold=flood_sleep_threshold)
+
+
+class PhoneSession(StringSession):
+    """
+    String session of phone which persists entities cache in local SQLite database.
+
+    Access hashes and resolved usernames survive tasks and worker restarts,
+    while authorization is still kept in `Phone.session`.
+    """
+
+    def __init__(self, phone: 'models.TypePhone'):
+        super().__init__(phone.session)
+
+        directory = os.environ.get('CELERY_SESSIONS_DIR', os.path.join(os.path.dirname(__file__), "sessions"))
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.filename = os.path.join(directory, f"{phone.id}.entities")
+
+        self._conn: 'sqlite3.Connection | None' = None
+
+        self._cursor().execute(
+            "create table if not exists entities ("
+            "id integer primary key, hash integer not null, username text, phone integer, name text, date integer"
+            ")"
+        )
+
+    def _cursor(self) -> 'sqlite3.Cursor':
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False, timeout=30, isolation_level=None)
+
+        return self._conn.cursor()
+
+    def _execute(self, stmt: 'str', *values) -> 'tuple | None':
+        c = self._cursor()
+
+        try:
+            return c.execute(stmt, values).fetchone()
+        finally:
+            c.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def process_entities(self, tlo):
+        rows = self._entities_to_rows(tlo)
+
+        if not rows:
+            return
+
+        now = (int(time.time()),)
+
+        c = self._cursor()
+
+        try:
+            c.executemany("insert or replace into entities values (?,?,?,?,?,?)", [row + now for row in rows])
+        finally:
+            c.close()
+
+    def get_entity_rows_by_phone(self, phone):
+        return self._execute("select id, hash from entities where phone = ?", phone)
+
+    def get_entity_rows_by_username(self, username):
+        return self._execute(
+            "select id, hash from entities where username = ? order by date desc limit 1", username
+        )
+
+    def get_entity_rows_by_name(self, name):
+        return self._execute("select id, hash from entities where name = ?", name)
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        if exact:
+            return self._execute("select id, hash from entities where id = ?", id)
+
+        return self._execute(
+            "select id, hash from entities where id in (?,?,?)",
+            telethon.utils.get_peer_id(types.PeerUser(id)),
+            telethon.utils.get_peer_id(types.PeerChat(id)),
+            telethon.utils.get_peer_id(types.PeerChannel(id))
+        )
+
+
+class ByteRate:
+    """Limits rate of transferred bytes per process, unlimited if `rate` is 0"""
+
+    def __init__(self, rate: 'int' = 0):
+        self.rate = rate
+
+        self._free_at = 0.0
+
+    async def consume(self, size: 'int') -> 'None':
+        """Waits until `size` bytes may be transferred"""
+
+        if not self.rate:
+            return
+
+        now = time.monotonic()
+        start = max(now, self._free_at)
+
+        self._free_at = start + size / self.rate
+
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class MediaStaging:
+    """
+    Memory-mapped local copy of media transferred to API.
+
+    Numbers of chunks written to disk are appended to `.parts` marker file, so
+    a crashed transfer may be resumed without downloading them again. Files are
+    removed once the transfer has succeeded.
+    """
+
+    DIR = os.environ.get('CELERY_MEDIA_STAGING_DIR') or None
+
+    def __init__(self, name: 'str', size: 'int'):
+        self.path = os.path.join(self.DIR, name)
+        self.size = size
+        self.parts: 'set[int]' = set()
+
+        self._file = None
+        self._marker = None
+        self._mmap: 'mmap.mmap | None' = None
+        self._views: 'list[memoryview]' = []
+
+    def __enter__(self) -> 'MediaStaging':
+        os.makedirs(self.DIR, exist_ok=True)
+
+        if os.path.exists(self.path) and os.path.getsize(self.path) == self.size:
+            self._file = open(self.path, "r+b")
+
+            with contextlib.suppress(FileNotFoundError), open(self.path + ".parts") as marker:
+                self.parts = {int(line) for line in marker if line.strip().isdigit()}
+        else:
+            self._file = open(self.path, "w+b")
+            self._file.truncate(self.size)
+
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path + ".parts")
+
+        self._marker = open(self.path + ".parts", "a")
+        self._mmap = mmap.mmap(self._file.fileno(), self.size)
+
+        return self
+
+    def _release_views(self) -> 'None':
+        views, self._views = self._views, []
+
+        for view in views:
+            # View re-exported to pending upload can't be released yet, mapping close reports it
+            with contextlib.suppress(BufferError):
+                view.release()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> 'None':
+        # Failed cleanup is only logged, so it never replaces exception of the transfer
+        for close in (self._release_views, self._mmap.close, self._marker.close, self._file.close):
+            try:
+                close()
+            except (BufferError, OSError) as ex:
+                # Mapping still exported to pending upload is closed once the upload is collected
+                logger.warning(f"Media staging {self.path} cleanup failed. Exception {ex}")
+
+        if exc_type is None:
+            for path in (self.path, self.path + ".parts"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def write(self, chunk_number: 'int', offset: 'int', data: 'bytes') -> 'None':
+        """Writes chunk to disk and marks it as staged"""
+
+        self._mmap[offset:offset + len(data)] = data
+
+        # Only pages of the chunk are synced, flushed range must start at page boundary
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self._mmap.flush(start, offset + len(data) - start)
+
+        self._marker.write(f"{chunk_number}\n")
+        self._marker.flush()
+
+        self.parts.add(chunk_number)
+
+    def view(self, offset: 'int', size: 'int') -> 'memoryview':
+        """Returns view of staged bytes without copying them"""
+
+        with memoryview(self._mmap) as whole:
+            view = whole[offset:offset + size]
+
+        self._views.append(view)
+
+        return view
+
+
+class RpcLimiter:
+    """
+    Paces telegram requests of each phone per request class.
+
+    Every request class of a phone has its own token bucket of `rate` requests
+    per second with `burst` capacity, and flood wait deadline reported by
+    telegram. If `CELERY_CACHE_URL` is set both are kept in Redis, so all
+    workers using the phone are paced together.
+    """
+
+    # Reserves token in bucket (GCRA), returns seconds to wait for it and seconds left of flood wait
+    SCRIPT = """
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local flood = tonumber(redis.call('GET', KEYS[2]) or '0')
+
+        if flood > now then
+            return {'0', tostring(flood - now)}
+        end
+
+        local interval = 1 / tonumber(ARGV[1])
+        local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now) + interval
+
+        redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+
+        return {tostring(math.max(0, tat - tonumber(ARGV[2]) * interval - now)), '0'}
+    """
+
+    def __init__(self, rate: 'float' = 0, burst: 'int' = 1, rates: 'dict[str, float] | None' = None):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.rates = rates or {}
+
+        self._buckets: 'dict[str, float]' = {}
+        self._floods: 'dict[str, float]' = {}
+
+    @staticmethod
+    def parse_rates(value: 'str') -> 'dict[str, float]':
+        """Returns request class rates from `Name=rate,...` string"""
+
+        rates = {}
+
+        for item in filter(None, value.split(",")):
+            name, rate = item.split("=")
+            rates[name.strip()] = float(rate)
+
+        return rates
+
+    @staticmethod
+    def rpc(request) -> 'str':
+        """Returns class name of request unwrapped from invoke wrappers"""
+
+        while isinstance(request, (functions.InvokeWithTakeoutRequest, functions.InvokeWithoutUpdatesRequest)):
+            request = request.query
+
+        return request.__class__.__name__
+
+    def _key(self, kind: 'str', phone_id: 'str', rpc: 'str') -> 'str':
+        return f"telegram-parser:{kind}:{phone_id}:{rpc}"
+
+    async def _reserve(self, phone_id: 'str', rpc: 'str', rate: 'float') -> 'tuple[float, float]':
+        bucket, flood = self._key("bucket", phone_id, rpc), self._key("flood", phone_id, rpc)
+
+        if SharedCache.aredis() is not None:
+            try:
+                wait, flood = await SharedCache.aredis().eval(self.SCRIPT, 2, bucket, flood, rate, self.burst)
+
+                return float(wait), float(flood)
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared rate limiter is unavailable. Exception {ex}")
+
+        now = time.time()
+
+        if self._floods.get(flood, 0) > now:
+            return 0, self._floods[flood] - now
+
+        interval = 1 / rate
+        self._buckets[bucket] = max(self._buckets.get(bucket, 0), now) + interval
+
+        return max(0.0, self._buckets[bucket] - self.burst * interval - now), 0
+
+    async def acquire(self, phone_id: 'str', request, flood_sleep_threshold: 'int') -> 'None':
+        """
+        Waits until phone may send request, raises `FloodWaitError` if flood wait is longer than threshold.
+
+        Request classes with rate 0 aren't paced and only flood waits known to this process are respected.
+        """
+
+        rpc = self.rpc(request)
+        rate = self.rates.get(rpc, self.rate)
+
+        while True:
+            if rate:
+                wait, flood = await self._reserve(phone_id, rpc, rate)
+            else:
+                wait, flood = 0, self._floods.get(self._key("flood", phone_id, rpc), 0) - time.time()
+
+            if flood <= 0:
+                break
+
+            if flood > flood_sleep_threshold:
+                raise telethon.errors.FloodWaitError(request=request, capture=math.ceil(flood))
+
+            await asyncio.sleep(flood)
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def flood(self, phone_id: 'str', request, seconds: 'int') -> 'None':
+        """Records flood wait of phone for request class"""
+
+        key = self._key("flood", phone_id, self.rpc(request))
+        deadline = time.time() + seconds
+
+        self._floods[key] = deadline
+
+        if SharedCache.aredis() is not None:
+            try:
+                await SharedCache.aredis().set(key, str(deadline), px=seconds * 1000)
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared rate limiter is unavailable. Exception {ex}")
+
+
+class PhoneScheduler:
+    """
+    Orders phones by health, tracks their usage and hands out exclusive leases.
+
+    Phone score grows with its flood wait, count of telegram client sessions
+    currently using it, share of failed sessions in recent `window` seconds and
+    count of its dialogs relative to `FULL_DIALOGS`. Lease gives task exclusive
+    use of phone (e.g. for takeout) and is prolonged every third of `lease_ttl`
+    while it's held. Flood waits are kept in `Phone.floods` per request class,
+    usage and leases are shared between all workers if `CELERY_CACHE_URL` is set.
+    """
+
+    FULL_DIALOGS = 500
+
+    # Prolongs lease only if it's still held with the same token
+    RENEW_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        end
+
+        return 0
+    """
+
+    # Removes lease only if it's still held with the same token
+    RELEASE_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+
+        return 0
+    """
+
+    def __init__(self, lease_ttl: 'int' = 3600, window: 'int' = 3600):
+        self.lease_ttl = lease_ttl
+        self.window = window
+
+        self._sessions: 'dict[str, dict[str, float]]' = collections.defaultdict(dict)
+        self._counters: 'dict[str, tuple[int, float | None]]' = {}
+        self._leases: 'dict[str, tuple[str, float]]' = {}
+
+    def _key(self, kind: 'str', phone_id: 'str') -> 'str':
+        return f"telegram-parser:{kind}:{phone_id}"
+
+    def _local_count(self, key: 'str') -> 'int':
+        count, expire_at = self._counters.get(key, (0, None))
+
+        return count if expire_at is None or expire_at > time.time() else 0
+
+    async def _counts(self, phone_id: 'str', *kinds: 'str') -> 'list[int]':
+        keys = [self._key(kind, phone_id) for kind in kinds]
+
+        if SharedCache.aredis() is not None:
+            try:
+                return [int(value or 0) for value in await SharedCache.aredis().mget(keys)]
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared phone scheduler is unavailable. Exception {ex}")
+
+        return [self._local_count(key) for key in keys]
+
+    async def _incr(self, kind: 'str', phone_id: 'str', amount: 'int' = 1, ttl: 'int | None' = None) -> 'None':
+        key = self._key(kind, phone_id)
+
+        if SharedCache.aredis() is not None:
+            try:
+                # Counter expires `ttl` seconds after its first increment
+                if await SharedCache.aredis().incrby(key, amount) == amount and ttl is not None:
+                    await SharedCache.aredis().expire(key, ttl)
+
+                return
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared phone scheduler is unavailable. Exception {ex}")
+
+        count, expire_at = self._local_count(key), self._counters.get(key, (0, None))[1]
+
+        if expire_at is not None and expire_at <= time.time():
+            expire_at = None
+
+        if ttl is not None and expire_at is None:
+            expire_at = time.time() + ttl
+
+        self._counters[key] = (count + amount, expire_at)
+
+    async def sessions(self, phone_id: 'str') -> 'int':
+        """Returns count of telegram client sessions currently using phone"""
+
+        now = time.time()
+
+        if SharedCache.aredis() is not None:
+            try:
+                key = self._key("sessions", phone_id)
+
+                await SharedCache.aredis().zremrangebyscore(key, "-inf", now)
+
+                return await SharedCache.aredis().zcard(key)
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared phone scheduler is unavailable. Exception {ex}")
+
+        return sum(1 for expire_at in self._sessions[phone_id].values() if expire_at > now)
+
+    async def open_session(self, phone_id: 'str') -> 'str':
+        """Counts telegram client session using phone, returns its token"""
+
+        token = os.urandom(8).hex()
+        expire_at = time.time() + self.lease_ttl
+
+        self._sessions[phone_id][token] = expire_at
+
+        if SharedCache.aredis() is not None:
+            try:
+                await SharedCache.aredis().zadd(self._key("sessions", phone_id), {token: expire_at})
+                await SharedCache.aredis().expire(self._key("sessions", phone_id), self.lease_ttl)
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared phone scheduler is unavailable. Exception {ex}")
+
+        return token
+
+    async def close_session(self, phone_id: 'str', token: 'str', error: 'bool' = False) -> 'None':
+        """Ends telegram client session using phone, counting it as failed with `error`"""
+
+        self._sessions[phone_id].pop(token, None)
+
+        if SharedCache.aredis() is not None:
+            try:
+                await SharedCache.aredis().zrem(self._key("sessions", phone_id), token)
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared phone scheduler is unavailable. Exception {ex}")
+
+        await self._incr("uses", phone_id, ttl=self.window)
+
+        if error:
+            await self._incr("errors", phone_id, ttl=self.window)
+
+    async def _take(self, phone_id: 'str') -> 'str | None':
+        token = os.urandom(8).hex()
+
+        if SharedCache.aredis() is not None:
+            try:
+                taken = await SharedCache.aredis().set(
+                    self._key("lease", phone_id), token, nx=True, px=self.lease_ttl * 1000
+                )
+
+                return token if taken else None
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared phone scheduler is unavailable. Exception {ex}")
+
+        held = self._leases.get(phone_id)
+
+        if held is not None and held[1] > time.time():
+            return None
+
+        self._leases[phone_id] = (token, time.time() + self.lease_ttl)
+
+        return token
+
+    async def _renew(self, phone_id: 'str', token: 'str') -> 'None':
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+
+            if self._leases.get(phone_id, (None,))[0] == token:
+                self._leases[phone_id] = (token, time.time() + self.lease_ttl)
+
+            if SharedCache.aredis() is not None:
+                try:
+                    await SharedCache.aredis().eval(
+                        self.RENEW_SCRIPT, 1, self._key("lease", phone_id), token, self.lease_ttl * 1000
+                    )
+                except redis.exceptions.RedisError as ex:
+                    logger.warning(f"Shared phone scheduler is unavailable. Exception {ex}")
+
+    async def _give(self, phone_id: 'str', token: 'str') -> 'None':
+        if self._leases.get(phone_id, (None,))[0] == token:
+            del self._leases[phone_id]
+
+        if SharedCache.aredis() is not None:
+            try:
+                await SharedCache.aredis().eval(self.RELEASE_SCRIPT, 1, self._key("lease", phone_id), token)
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared phone scheduler is unavailable. Exception {ex}")
+
+    @contextlib.asynccontextmanager
+    async def lease(self, phone_id: 'str') -> 'typing.AsyncIterator[bool]':
+        """Holds exclusive lease of phone while context is open, yields `False` if phone is leased by another task"""
+
+        token = await self._take(phone_id)
+
+        if token is None:
+            yield False
+
+            return
+
+        renew = asyncio.create_task(self._renew(phone_id, token))
+
+        try:
+            yield True
+        finally:
+            renew.cancel()
+
+            await self._give(phone_id, token)
+
+    async def set_dialogs(self, phone_id: 'str', count: 'int') -> 'None':
+        """Stores count of phone dialogs"""
+
+        dialogs, = await self._counts(phone_id, "dialogs")
+
+        await self._incr("dialogs", phone_id, count - dialogs)
+
+    async def add_dialog(self, phone_id: 'str') -> 'None':
+        """Counts new dialog of phone"""
+
+        await self._incr("dialogs", phone_id)
+
+    @staticmethod
+    def flood_wait(phone: 'models.TypePhone', rpc: 'str | None' = None) -> 'float':
+        """Returns seconds left of phone flood wait for request class, or of the longest one"""
+
+        floods = phone.floods or {}
+        deadlines = [floods.get(rpc, 0)] if rpc is not None else list(floods.values())
+
+        return max([0.0] + [deadline - time.time() for deadline in deadlines])
+
+    async def score(self, phone: 'models.TypePhone', rpc: 'str | None' = None) -> 'float':
+        """Returns phone load for request class, the less the better"""
+
+        flood = self.flood_wait(phone, rpc)
+        uses, errors, dialogs = await self._counts(phone.id, "uses", "errors", "dialogs")
+
+        return (
+            (1000 + flood if flood > 0 else 0)
+            + await self.sessions(phone.id)
+            + errors / max(1, uses) * 10
+            + dialogs / self.FULL_DIALOGS * 5
+        )
+
+    async def flood(self, phone: 'models.TypePhone', rpc: 'str', seconds: 'int') -> 'None':
+        """Marks phone as flooded for request class until its flood wait expires"""
+
+        await phone.areload()
+
+        now = time.time()
+
+        phone.floods = {name: deadline for name, deadline in (phone.floods or {}).items() if deadline > now}
+        phone.floods[rpc] = max(phone.floods.get(rpc, 0), now + seconds)
+
+        phone.status = models.Phone.FLOOD
+        phone.status_text = ", ".join(
+            f"{name} flood wait until {time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(deadline))}"
+            for name, deadline in sorted(phone.floods.items())
+        )
+        await phone.asave()
+
+    async def order(self, items: 'list', key: 'typing.Callable' = lambda item: item,
+                    rpc: 'str | None' = None) -> 'list':
+        """
+        Returns items sorted by score of their phone for request class (any class if not given).
+
+        Flooded phones which flood waits have expired are made ready again.
+        """
+
+        scores = {}
+
+        for item in items:
+            phone = key(item)
+
+            if isinstance(phone, models.RelatedEntity):
+                phone = await phone.aresolve()
+
+            if phone.status == models.Phone.FLOOD and self.flood_wait(phone) <= 0:
+                phone.status = models.Phone.READY
+                phone.status_text = None
+                phone.floods = None
+                await phone.asave()
+
+            scores[id(item)] = await self.score(phone, rpc)
+
+        return sorted(items, key=lambda item: scores[id(item)])
 
 
 class TelegramClient(OpenteleClient):
@@ -74,6 +703,23 @@ class TelegramClient(OpenteleClient):
         API.TelegramMacOS,
     ]
 
+    MEDIA_RATE = ByteRate(int(os.environ.get('CELERY_MEDIA_RATE', 0)))
+    MEDIA_PARALLEL = max(1, int(os.environ.get('CELERY_MEDIA_PARALLEL', 4)))
+    PARTICIPANTS_PARALLEL = max(1, int(os.environ.get('CELERY_PARTICIPANTS_PARALLEL', 4)))
+    MEMBERS_SEARCH_DEPTH = max(1, int(os.environ.get('CELERY_MEMBERS_SEARCH_DEPTH', 3)))
+    LIMITER = RpcLimiter(
+        float(os.environ.get('CELERY_PHONE_RPC_RATE', 0)),
+        int(os.environ.get('CELERY_PHONE_RPC_BURST', 5)),
+        RpcLimiter.parse_rates(os.environ.get('CELERY_PHONE_RPC_RATES', "GetFileRequest=0"))
+    )
+    SCHEDULER = PhoneScheduler(
+        int(os.environ.get('CELERY_PHONE_LEASE_TTL', 3600)),
+        int(os.environ.get('CELERY_PHONE_HEALTH_WINDOW', 3600))
+    )
+
+    # Set while Telethon sends request, so it raises flood waits instead of sleeping them
+    _raising_floods: 'contextvars.ContextVar[bool]' = contextvars.ContextVar("raising_floods", default=False)
+
     def __init__(self, phone: 'models.TypePhone', *args, **kwargs):
         self.phone = phone
 
@@ -89,14 +735,126 @@ class TelegramClient(OpenteleClient):
             **kwargs,
             connection_retries=-1,
             retry_delay=5,
-            session=StringSession(phone.session),
+            session=PhoneSession(phone),
             api=APIData(**self.phone.api)
         )
 
+        self._session_token = None
+
+    async def __aenter__(self):
+        self._session_token = await self.SCHEDULER.open_session(self.phone.id)
+
+        try:
+            return await super().__aenter__()
+        except BaseException:
+            await self.SCHEDULER.close_session(self.phone.id, self._session_token, error=True)
+
+            raise
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            return await super().__aexit__(exc_type, exc_value, traceback)
+        finally:
+            await self.SCHEDULER.close_session(self.phone.id, self._session_token, error=exc_type is not None)
+
+    @property
+    def flood_sleep_threshold(self):
+        return 0 if self._raising_floods.get() else OpenteleClient.flood_sleep_threshold.fget(self)
+
+    @flood_sleep_threshold.setter
+    def flood_sleep_threshold(self, value):
+        OpenteleClient.flood_sleep_threshold.fset(self, value)
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        # Telethon drops `flood_sleep_threshold` here
+        return await self._call(self._sender, request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        """Paces request with other workers using the phone and shares its flood waits with them"""
+
+        if flood_sleep_threshold is None:
+            flood_sleep_threshold = OpenteleClient.flood_sleep_threshold.fget(self)
+
+        requests = request if telethon.utils.is_list_like(request) else (request,)
+
+        while True:
+            for r in requests:
+                await self.LIMITER.acquire(self.phone.id, r, flood_sleep_threshold)
+
+            # Telethon decides to sleep by client threshold, it's 0 here to raise every
+            # flood wait, so it's recorded for other workers before it's slept below
+            raising = self._raising_floods.set(True)
+
+            try:
+                return await super()._call(sender, request, ordered=ordered, flood_sleep_threshold=0)
+            except (telethon.errors.SlowModeWaitError, telethon.errors.FloodTestPhoneWaitError) as ex:
+                # Slow mode waits are chat-specific and test phone ones are test-only, so they aren't shared
+                if ex.seconds > flood_sleep_threshold:
+                    raise ex
+
+                await asyncio.sleep(ex.seconds)
+            except telethon.errors.FloodWaitError as ex:
+                flooded = ex.request or requests[0]
+
+                await self.LIMITER.flood(self.phone.id, flooded, ex.seconds)
+
+                # Telethon keys flood waits by constructor, so takeout ones would block every request
+                self._flood_waited_requests.clear()
+
+                if ex.seconds > flood_sleep_threshold:
+                    await self.SCHEDULER.flood(self.phone, RpcLimiter.rpc(flooded), ex.seconds)
+
+                    raise ex
+
+                logger.warning(f"Phone {self.phone.id} must wait {ex.seconds} before {RpcLimiter.rpc(flooded)}.")
+            finally:
+                self._raising_floods.reset(raising)
+
     class __ParticipantsIter(_ParticipantsIter):
+        async def _init(self, entity, filter, search, aggressive, adaptive=False):
+            # Alphabet to extend prefixes of aggressive search with
+            self.alphabet = search if aggressive and adaptive else ''
+
+            return await super()._init(entity, filter, search, aggressive)
+
+        def _expand(self, request, count: 'int') -> 'list':
+            """Returns requests of longer prefixes if server has returned less members than prefix matches"""
+
+            q = request.filter.q
+
+            if not self.alphabet or request.offset >= count or len(q) >= self.client.MEMBERS_SEARCH_DEPTH:
+                return []
+
+            return [
+                functions.channels.GetParticipantsRequest(
+                    channel=request.channel,
+                    filter=types.ChannelParticipantsSearch(q + x),
+                    offset=0,
+                    limit=_MAX_PARTICIPANTS_CHUNK_SIZE,
+                    hash=0
+                ) for x in self.alphabet
+            ]
+
+        async def _request(self, request, semaphore: 'asyncio.Semaphore'):
+            """Send request, flood waits are shared with other requests of phone by client"""
+
+            async with semaphore:
+                return await self.client(request)
+
         async def _load_next_chunk(self):
-            if not self.requests:
-                return True
+            # Iteration stops on empty buffer, so rounds which only expand prefixes
+            # or return seen members are followed by next ones until members come
+            while not self.buffer:
+                if not self.requests:
+                    return True
+
+                if not await self._load_round():
+                    return True
+
+            return not self.requests
+
+        async def _load_round(self) -> 'bool':
+            """Sends one request per prefix, returns `False` if limit is reached"""
 
             # Only care about the limit for the first request
             # (small amount of people, won't be aggressive).
@@ -108,7 +866,7 @@ class TelegramClient(OpenteleClient):
                 self.limit - self.requests[0].offset, _MAX_PARTICIPANTS_CHUNK_SIZE)
 
             if self.requests[0].offset > self.limit:
-                return True
+                return False
 
             if self.total is None:
                 f = self.requests[0].filter
@@ -127,7 +885,21 @@ class TelegramClient(OpenteleClient):
                         hash=0
                     ))).count
 
-            results = [await self.client(request) for request in self.requests]
+            semaphore = asyncio.Semaphore(self.client.PARTICIPANTS_PARALLEL)
+            tasks = [asyncio.ensure_future(self._request(request, semaphore)) for request in self.requests]
+
+            try:
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                # E.g. long flood wait of one request, other ones mustn't be left running
+                for task in tasks:
+                    task.cancel()
+
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+                raise
+
+            expanded = []
 
             for i in reversed(range(len(self.requests))):
                 participants = results[i]
@@ -135,7 +907,7 @@ class TelegramClient(OpenteleClient):
                     # Will only get here if there was one request with a filter that matched all users.
                     self.total = participants.count
                 if not participants.users:
-                    self.requests.pop(i)
+                    expanded.extend(self._expand(self.requests.pop(i), participants.count))
                     continue
 
                 self.requests[i].offset += len(participants.participants)
@@ -158,6 +930,14 @@ class TelegramClient(OpenteleClient):
                     user.participant = participant
                     self.buffer.append(user)
 
+                # All members matching prefix are fetched, don't request empty page
+                if self.alphabet and self.requests[i].offset >= participants.count:
+                    self.requests.pop(i)
+
+            self.requests.extend(expanded)
+
+            return True
+
     def iter_participants(
             self: 'TelegramClient',
             entity: 'hints.EntityLike',
@@ -165,22 +945,32 @@ class TelegramClient(OpenteleClient):
             *,
             search: str = '',
             filter: 'types.TypeChannelParticipantsFilter' = None,
-            aggressive: bool = False) -> _ParticipantsIter:
+            aggressive: bool = False,
+            adaptive: bool = False) -> _ParticipantsIter:
+        """
+        With `aggressive` members are searched by every `search` character,
+        with `adaptive` too prefixes which have more matches than server returns
+        are searched extended by every character.
+        """
+
         return self.__ParticipantsIter(
             self,
             limit,
             entity=entity,
             filter=filter,
             search=search,
-            aggressive=aggressive
+            aggressive=aggressive,
+            adaptive=adaptive
         )
 
     async def _sync_dialogs(self):
         dialogs = await self.get_dialogs(limit=0)
 
-        if dialogs.total >= 500:
+        await self.SCHEDULER.set_dialogs(self.phone.id, dialogs.total)
+
+        if dialogs.total >= self.SCHEDULER.FULL_DIALOGS:
             self.phone.status = models.Phone.FULL
-            self.phone.save()
+            await self.phone.asave()
 
         async for dialog in self.iter_dialogs():
             if dialog.is_user:
@@ -188,9 +978,9 @@ class TelegramClient(OpenteleClient):
 
             internal_id = telethon.utils.get_peer_id(dialog.dialog.peer)
 
-            for chat in models.Chat.find(internal_id=internal_id):
-                if not models.ChatPhone.find(chat=chat, phone=self.phone):
-                    models.ChatPhone(chat=chat, phone=self.phone, is_using=True).save()
+            for chat in await models.Chat.afind(internal_id=internal_id):
+                if not await models.ChatPhone.afind(chat=chat.id, phone=self.phone.id):
+                    await models.ChatPhone(chat=chat, phone=self.phone, is_using=True).asave()
 
     async def start(self):
         try:
@@ -206,7 +996,7 @@ class TelegramClient(OpenteleClient):
             self.phone.status = models.Phone.CREATED
             self.phone.status_text = "Unauthorized"
 
-        self.phone.save()
+        await self.phone.asave()
 
         raise exceptions.UnauthorizedError(self.phone.status_text)
 
@@ -216,7 +1006,7 @@ class TelegramClient(OpenteleClient):
         while True:
             await asyncio.sleep(10)
 
-            self.phone.reload()
+            await self.phone.areload()
 
             if self.phone.code is not None:
                 return self.phone.code
@@ -261,7 +1051,7 @@ class TelegramClient(OpenteleClient):
             ):
                 self.phone.code = None
                 self.phone.status_text = "Invalid code. Please try again."
-                self.phone.save()
+                await self.phone.asave()
 
             attempts += 1
         else:
@@ -275,154 +1065,549 @@ class TelegramClient(OpenteleClient):
         self.phone.status = models.Phone.READY
         self.phone.status_text = None
         self.phone.code = None
-        self.phone.save()
+        await self.phone.asave()
 
         await self._sync_dialogs()
 
-        return self
+        return self
+
+    def takeout(
+            self,
+            finalize: bool = True,
+            *,
+            contacts: bool = None,
+            users: bool = None,
+            chats: bool = None,
+            megagroups: bool = None,
+            channels: bool = None,
+            files: bool = None,
+            max_file_size: bool = None):
+        """Override"""
+        request_kwargs = dict(
+            contacts=contacts,
+            message_users=users,
+            message_chats=chats,
+            message_megagroups=megagroups,
+            message_channels=channels,
+            files=files,
+            file_max_size=max_file_size
+        )
+        arg_specified = (arg is not None for arg in request_kwargs.values())
+
+        if self.session.takeout_id is None or any(arg_specified):
+            request = functions.account.InitTakeoutSessionRequest(
+                **request_kwargs)
+        else:
+            request = None
+
+        return _TakeoutClient(finalize, self, request)
+
+    async def end_takeout(self, success: bool) -> bool:
+        try:
+            async with _TakeoutClient(True, self, None) as takeout:
+                takeout.success = success
+        except ValueError:
+            return False
+        return True
+
+    async def resolve(self, string: 'str'):
+        """Resolve entity from string"""
+
+        username, is_join_chat = utils.parse_username(string)
+
+        if is_join_chat:
+            invite = await self(telethon.functions.messages.CheckChatInviteRequest(username))
+
+            if isinstance(invite, telethon.types.ChatInvite):
+                return invite
+            elif isinstance(invite, telethon.types.ChatInviteAlready):
+                return invite.chat
+        elif username:
+            return await self.resolve_username(username)
+
+        raise ValueError(f"Cannot find any entity corresponding to '{string}' in {self}.")
+
+    async def resolve_username(self, username: 'str'):
+        """Returns entity by username, resolving it only if it's missing in session entities cache"""
+
+        try:
+            input_entity = self.session.get_input_entity(username)
+        except ValueError:
+            # Resolved entity is put in session entities cache
+            return await self.get_entity(username)
+
+        return await self.get_entity(input_entity)
+
+    async def join(self, string: 'str'):
+        """Join to chat by phone"""
+
+        username, is_join_chat = utils.parse_username(string)
+
+        if is_join_chat:
+            invite = await self(telethon.functions.messages.CheckChatInviteRequest(username))
+
+            if isinstance(invite, telethon.types.ChatInviteAlready):
+                return invite.chat
+            else:
+                updates = await self(telethon.functions.messages.ImportChatInviteRequest(username))
+
+                return updates.chats[-1]
+        elif username:
+            updates = await self(telethon.functions.channels.JoinChannelRequest(username))
+
+            return updates.chats[-1]
+
+        raise ValueError(f"Cannot find any entity corresponding to '{string}' in {self}.")
+
+    async def get_messages_count(self, entity: 'hints.EntityLike'):
+        messages = await self.get_messages(entity, limit=0)
+
+        return messages.total
+
+    async def get_participants_count(self, entity: 'hints.EntityLike'):
+        if entity.participants_count is None:
+            try:
+                participants = await self.get_participants(entity, limit=0)
+
+                return participants.total
+            except (
+                telethon.errors.ChannelPrivateError,
+                telethon.errors.ChatAdminRequiredError
+            ):
+                pass
+
+        return entity.participants_count or 0
+
+    async def _download_chunk(self, loc, chunk_number: 'int', chunk_size: 'int', file_size: 'int') -> 'bytes':
+        async for chunk in self.iter_download(loc, offset=chunk_number * chunk_size, limit=1, chunk_size=chunk_size,
+                                              request_size=chunk_size, file_size=file_size):
+            await self.MEDIA_RATE.consume(len(chunk))
+
+            return chunk
+
+        return b""
+
+    async def download_media(self, media, loc, file_size, extension):
+        """
+        Download media from telegram and upload it to API by chunks.
+
+        Up to `MEDIA_PARALLEL` chunks are downloaded concurrently, while already
+        downloaded ones are uploaded one by one in order. Chunks already stored
+        on server are skipped. If `CELERY_MEDIA_STAGING_DIR` is set, chunks are
+        staged on disk and uploaded from there.
+        """
+
+        chunk_size = downloads.MAX_CHUNK_SIZE
+        total_chunks = math.ceil(file_size / chunk_size)
+        filename = str(loc.id) + extension
+
+        staging = None
+
+        if MediaStaging.DIR is not None and file_size > 0:
+            staging = MediaStaging(f"{media._endpoint}.{media.id}.{filename}", file_size)
+
+        async def fetch(chunk_number: 'int') -> 'bytes | memoryview':
+            if staging is None:
+                return await self._download_chunk(loc, chunk_number, chunk_size, file_size)
+
+            offset = chunk_number * chunk_size
+
+            if chunk_number not in staging.parts:
+                chunk = await self._download_chunk(loc, chunk_number, chunk_size, file_size)
+
+                staging.write(chunk_number, offset, chunk)
+
+            return staging.view(offset, min(chunk_size, file_size - offset))
+
+        in_flight: 'collections.deque[tuple[int, asyncio.Task]]' = collections.deque()
+        upload: 'asyncio.Task | None' = None
+
+        async def commit(upload: 'asyncio.Task | None') -> 'asyncio.Task':
+            chunk_number, download = in_flight.popleft()
+            chunk = await download
+
+            if upload is not None:
+                await upload
+
+            return asyncio.create_task(ApiService().achunk(
+                media._endpoint, media.id, filename, chunk,
+                chunk_number, chunk_size, total_chunks, file_size
+            ))
+
+        with staging if staging is not None else contextlib.nullcontext():
+            stored = await ApiService().achunks(media._endpoint, media.id, filename)
+
+            try:
+                for chunk_number in range(total_chunks):
+                    if chunk_number in stored:
+                        continue
+
+                    in_flight.append((chunk_number, asyncio.create_task(fetch(chunk_number))))
+
+                    if len(in_flight) >= self.MEDIA_PARALLEL:
+                        upload = await commit(upload)
+
+                while in_flight:
+                    upload = await commit(upload)
+
+                if upload is not None:
+                    await upload
+            finally:
+                for _, download in in_flight:
+                    download.cancel()
+
+                if upload is not None and not upload.done():
+                    upload.cancel()
+
+
+TypeTelegramClient = TelegramClient
+
+
+class CachePolicy:
+    """Eviction policy of cached endpoint entities"""
+
+    def __init__(self, max_size: 'int' = 1000, ttl: 'float | None' = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+
+
+class Cache:
+    """Bounded LRU/TTL cache of API entities namespaced by endpoint"""
+
+    DEFAULT_POLICY = CachePolicy(
+        max_size=int(os.environ.get('CELERY_API_CACHE_SIZE', 1000)),
+        ttl=float(os.environ.get('CELERY_API_CACHE_TTL', 300))
+    )
+
+    POLICIES = {
+        "phones": CachePolicy(max_size=100, ttl=10),
+        "chats-tasks": CachePolicy(max_size=100, ttl=10),
+        "chats-phones": CachePolicy(max_size=1000, ttl=60),
+        "chats": CachePolicy(max_size=1000, ttl=60),
+        "members": CachePolicy(max_size=10000, ttl=3600),
+        "chats-members": CachePolicy(max_size=10000, ttl=3600),
+        "messages": CachePolicy(max_size=5000, ttl=600),
+    }
+
+    def __init__(self, policies: 'dict[str, CachePolicy]' = None, default: 'CachePolicy' = None):
+        self.policies = dict(self.POLICIES, **(policies or {}))
+        self.default = default or self.DEFAULT_POLICY
+
+        self._data: 'dict[str, collections.OrderedDict[str, tuple[float | None, dict]]]' = {}
+        self._stats: 'dict[str, dict[str, int]]' = {}
+
+    def policy(self, endpoint: 'str') -> 'CachePolicy':
+        """Returns eviction policy of endpoint"""
+
+        return self.policies.get(endpoint, self.default)
+
+    def _count(self, endpoint: 'str', counter: 'str') -> 'None':
+        stats = self._stats.setdefault(endpoint, {"hits": 0, "misses": 0, "evictions": 0})
+        stats[counter] += 1
+
+    def get(self, endpoint: 'str', id: 'str') -> 'dict | None':
+        """Returns cached entity or `None` if it is missing or expired"""
+
+        items = self._data.get(endpoint)
+
+        if items is None or id not in items:
+            self._count(endpoint, "misses")
+
+            return None
+
+        expires, entity = items[id]
+
+        if expires is not None and expires <= time.monotonic():
+            del items[id]
+
+            self._count(endpoint, "evictions")
+            self._count(endpoint, "misses")
+
+            return None
+
+        items.move_to_end(id)
+
+        self._count(endpoint, "hits")
+
+        return entity
+
+    def set(self, endpoint: 'str', id: 'str', entity: 'dict') -> 'dict':
+        """Puts entity in cache evicting least recently used ones if endpoint is full"""
+
+        policy = self.policy(endpoint)
+        items = self._data.setdefault(endpoint, collections.OrderedDict())
+
+        items[id] = (time.monotonic() + policy.ttl if policy.ttl is not None else None, entity)
+        items.move_to_end(id)
+
+        while len(items) > policy.max_size:
+            items.popitem(last=False)
+
+            self._count(endpoint, "evictions")
+
+        return entity
+
+    def delete(self, endpoint: 'str', id: 'str') -> 'None':
+        """Removes entity from cache"""
+
+        self._data.get(endpoint, {}).pop(id, None)
+
+    def clear(self, endpoint: 'str' = None) -> 'None':
+        """Removes all entities of endpoint (or of all endpoints) from cache"""
+
+        if endpoint is None:
+            self._data.clear()
+        else:
+            self._data.pop(endpoint, None)
+
+    def stats(self, endpoint: 'str' = None) -> 'dict':
+        """Returns hits/misses/evictions counters and size of endpoint (or of all endpoints)"""
+
+        endpoints = [endpoint] if endpoint is not None else set(self._data) | set(self._stats)
+
+        return {
+            endpoint: dict(
+                self._stats.get(endpoint, {"hits": 0, "misses": 0, "evictions": 0}),
+                size=len(self._data.get(endpoint, {}))
+            ) for endpoint in endpoints
+        }
+
+
+class SharedCache:
+    """
+    Key-value cache shared between tasks.
+
+    Values are kept in-process and, if `CELERY_CACHE_URL` is set, in Redis,
+    so they are shared between all workers of the cluster. Coroutines must use
+    asynchronous methods, so Redis round trips don't block the event loop.
+    """
+
+    _redis: 'redis.Redis | None' = None
+    _async_redis: 'redis.asyncio.Redis | None' = None
+    _async_loop: 'asyncio.AbstractEventLoop | None' = None
+    _writes: 'set[asyncio.Future]' = set()
+
+    def __init__(self, namespace: 'str', ttl: 'float | None' = None, max_size: 'int' = 10000):
+        self.namespace = namespace
+        self.ttl = ttl
+
+        self._local = Cache(policies={namespace: CachePolicy(max_size=max_size, ttl=ttl)})
+
+    @classmethod
+    def redis(cls) -> 'redis.Redis | None':
+        """Returns Redis client or `None` if shared storage isn't configured"""
+
+        if cls._redis is None and os.environ.get('CELERY_CACHE_URL'):
+            cls._redis = redis.Redis.from_url(os.environ['CELERY_CACHE_URL'])
+
+        return cls._redis
+
+    @classmethod
+    def aredis(cls) -> 'redis.asyncio.Redis | None':
+        """Returns asynchronous Redis client bound to the running event loop or `None` if it isn't configured"""
+
+        if not os.environ.get('CELERY_CACHE_URL'):
+            return None
+
+        loop = asyncio.get_running_loop()
+
+        if cls._async_redis is None or cls._async_loop is not loop:
+            cls._async_redis = redis.asyncio.Redis.from_url(os.environ['CELERY_CACHE_URL'])
+            cls._async_loop = loop
+
+        return cls._async_redis
+
+    @classmethod
+    async def aclose(cls) -> 'None':
+        """Wait for background writes and close Redis connections of the running event loop"""
+
+        if cls._writes:
+            await asyncio.gather(*cls._writes, return_exceptions=True)
+
+        if cls._async_redis is not None and cls._async_loop is asyncio.get_running_loop():
+            await cls._async_redis.close()
+
+        cls._async_redis = None
+        cls._async_loop = None
+
+    def _key(self, key) -> 'str':
+        return f"telegram-parser:{self.namespace}:{key}"
+
+    def get(self, key) -> 'object | None':
+        """Returns cached value or `None`"""
+
+        value = self._local.get(self.namespace, str(key))
+
+        if value is not None or self.redis() is None:
+            return value
+
+        try:
+            value = self.redis().get(self._key(key))
+        except redis.exceptions.RedisError as ex:
+            logger.warning(f"Shared cache {self.namespace} is unavailable. Exception {ex}")
+
+            return None
+
+        if value is None:
+            return None
+
+        return self._local.set(self.namespace, str(key), json.loads(value))
+
+    def set(self, key, value, ttl: 'float | None' = None) -> 'object':
+        """Puts value in cache for `ttl` seconds (namespace TTL by default)"""
+
+        ttl = ttl if ttl is not None else self.ttl
+
+        self._local.set(self.namespace, str(key), value)
+
+        if self.redis() is not None:
+            try:
+                self.redis().set(self._key(key), json.dumps(value), px=int(ttl * 1000) if ttl else None)
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared cache {self.namespace} is unavailable. Exception {ex}")
 
-    def takeout(
-            self,
-            finalize: bool = True,
-            *,
-            contacts: bool = None,
-            users: bool = None,
-            chats: bool = None,
-            megagroups: bool = None,
-            channels: bool = None,
-            files: bool = None,
-            max_file_size: bool = None):
-        """Override"""
-        request_kwargs = dict(
-            contacts=contacts,
-            message_users=users,
-            message_chats=chats,
-            message_megagroups=megagroups,
-            message_channels=channels,
-            files=files,
-            file_max_size=max_file_size
-        )
-        arg_specified = (arg is not None for arg in request_kwargs.values())
+        return value
 
-        if self.session.takeout_id is None or any(arg_specified):
-            request = functions.account.InitTakeoutSessionRequest(
-                **request_kwargs)
-        else:
-            request = None
+    def delete(self, key) -> 'None':
+        """Removes value from cache"""
 
-        return _TakeoutClient(finalize, self, request)
+        self._local.delete(self.namespace, str(key))
 
-    async def end_takeout(self, success: bool) -> bool:
-        try:
-            async with _TakeoutClient(True, self, None) as takeout:
-                takeout.success = success
-        except ValueError:
-            return False
-        return True
+        if self.redis() is not None:
+            try:
+                self.redis().delete(self._key(key))
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared cache {self.namespace} is unavailable. Exception {ex}")
 
-    async def resolve(self, string: 'str'):
-        """Resolve entity from string"""
+    async def aget(self, key) -> 'object | None':
+        """Returns cached value or `None` asynchronously"""
 
-        username, is_join_chat = utils.parse_username(string)
+        value = self._local.get(self.namespace, str(key))
 
-        if is_join_chat:
-            invite = await self(telethon.functions.messages.CheckChatInviteRequest(username))
+        if value is not None or self.aredis() is None:
+            return value
 
-            if isinstance(invite, telethon.types.ChatInvite):
-                return invite
-            elif isinstance(invite, telethon.types.ChatInviteAlready):
-                return invite.chat
-        elif username:
-            return await self.get_entity(username)
+        try:
+            value = await self.aredis().get(self._key(key))
+        except redis.exceptions.RedisError as ex:
+            logger.warning(f"Shared cache {self.namespace} is unavailable. Exception {ex}")
 
-        raise ValueError(f"Cannot find any entity corresponding to '{string}' in {self}.")
+            return None
 
-    async def join(self, string: 'str'):
-        """Join to chat by phone"""
+        if value is None:
+            return None
 
-        username, is_join_chat = utils.parse_username(string)
+        return self._local.set(self.namespace, str(key), json.loads(value))
 
-        if is_join_chat:
-            invite = await self(telethon.functions.messages.CheckChatInviteRequest(username))
+    async def _ashare(self, key, value, ttl: 'float | None') -> 'None':
+        try:
+            await self.aredis().set(self._key(key), json.dumps(value), px=int(ttl * 1000) if ttl else None)
+        except redis.exceptions.RedisError as ex:
+            logger.warning(f"Shared cache {self.namespace} is unavailable. Exception {ex}")
 
-            if isinstance(invite, telethon.types.ChatInviteAlready):
-                return invite.chat
-            else:
-                updates = await self(telethon.functions.messages.ImportChatInviteRequest(username))
+    async def aset(self, key, value, ttl: 'float | None' = None) -> 'object':
+        """Puts value in cache for `ttl` seconds (namespace TTL by default) asynchronously"""
 
-                return updates.chats[-1]
-        elif username:
-            updates = await self(telethon.functions.channels.JoinChannelRequest(username))
+        ttl = ttl if ttl is not None else self.ttl
 
-            return updates.chats[-1]
+        self._local.set(self.namespace, str(key), value)
 
-        raise ValueError(f"Cannot find any entity corresponding to '{string}' in {self}.")
+        if self.aredis() is not None:
+            await self._ashare(key, value, ttl)
 
-    async def get_messages_count(self, entity: 'hints.EntityLike'):
-        messages = await self.get_messages(entity, limit=0)
+        return value
 
-        return messages.total
+    def set_soon(self, key, value, ttl: 'float | None' = None) -> 'object':
+        """Puts value in cache from callback of the running event loop, Redis is written in background"""
 
-    async def get_participants_count(self, entity: 'hints.EntityLike'):
-        if entity.participants_count is None:
-            try:
-                participants = await self.get_participants(entity, limit=0)
+        ttl = ttl if ttl is not None else self.ttl
 
-                return participants.total
-            except (
-                telethon.errors.ChannelPrivateError,
-                telethon.errors.ChatAdminRequiredError
-            ):
-                pass
+        self._local.set(self.namespace, str(key), value)
 
-        return entity.participants_count or 0
+        if self.aredis() is not None:
+            write = asyncio.ensure_future(self._ashare(key, value, ttl))
 
-    async def download_media(self, media, loc, file_size, extension):
-        chunk_number = 0
-        chunk_size = downloads.MAX_CHUNK_SIZE
-        total_chunks = math.ceil(file_size / chunk_size)
+            self._writes.add(write)
+            write.add_done_callback(self._writes.discard)
 
-        async for chunk in self.iter_download(loc, chunk_size=chunk_size, file_size=file_size):
-            ApiService().chunk(
-                media._endpoint, media.id, str(loc.id) + extension, chunk,
-                chunk_number, chunk_size, total_chunks, file_size
-            )
+        return value
 
-            chunk_number += 1
+    async def adelete(self, key) -> 'None':
+        """Removes value from cache asynchronously"""
 
+        self._local.delete(self.namespace, str(key))
 
-TypeTelegramClient = TelegramClient
+        if self.aredis() is not None:
+            try:
+                await self.aredis().delete(self._key(key))
+            except redis.exceptions.RedisError as ex:
+                logger.warning(f"Shared cache {self.namespace} is unavailable. Exception {ex}")
 
 
 class ApiService(metaclass=Singleton):
     """Service for working with API"""
-    _cache = {}
+    _cache = Cache()
+    _no_bulk = set()
+
+    def __init__(self):
+        self._pool_size = int(os.environ.get('CELERY_API_POOL_SIZE', 10))
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._async_session: 'aiohttp.ClientSession | None' = None
+        self._async_loop: 'asyncio.AbstractEventLoop | None' = None
 
     def _get(self, endpoint: 'str', id: 'str', force: 'bool' = False):
-        if id not in self._cache or force:
-            self._cache[id] = self.send("GET", endpoint, f"{id}/")
+        entity = self._cache.get(endpoint, id) if not force else None
+
+        if entity is None:
+            entity = self._cache.set(endpoint, id, self.send("GET", endpoint, f"{id}/"))
 
-        return self._cache[id]
+        return entity
 
     def _filter(self, endpoint: 'str', **kwargs):
         result = self.send("GET", endpoint, "?" + urllib.parse.urlencode(kwargs))
 
         for entity in result["results"]:
-            self._cache[entity["id"]] = entity
+            self._cache.set(endpoint, entity["id"], entity)
 
         return result
 
     def _create(self, endpoint: 'str', **kwargs):
         entity = self.send("POST", endpoint, "", body=kwargs)
 
-        self._cache[entity["id"]] = entity
-
-        return self._cache[entity["id"]]
+        return self._cache.set(endpoint, entity["id"], entity)
 
     def _update(self, endpoint: 'str', id: 'str', **kwargs):
-        self._cache[id] = self.send("PUT", endpoint, f"{id}/", body=kwargs)
+        return self._cache.set(endpoint, id, self.send("PUT", endpoint, f"{id}/", body=kwargs))
+
+    async def _aget(self, endpoint: 'str', id: 'str', force: 'bool' = False):
+        entity = self._cache.get(endpoint, id) if not force else None
 
-        return self._cache[id]
+        if entity is None:
+            entity = self._cache.set(endpoint, id, await self.asend("GET", endpoint, f"{id}/"))
+
+        return entity
+
+    async def _afilter(self, endpoint: 'str', **kwargs):
+        result = await self.asend("GET", endpoint, "?" + urllib.parse.urlencode(kwargs))
+
+        for entity in result["results"]:
+            self._cache.set(endpoint, entity["id"], entity)
+
+        return result
+
+    async def _acreate(self, endpoint: 'str', **kwargs):
+        entity = await self.asend("POST", endpoint, "", body=kwargs)
+
+        return self._cache.set(endpoint, entity["id"], entity)
+
+    async def _aupdate(self, endpoint: 'str', id: 'str', **kwargs):
+        return self._cache.set(endpoint, id, await self.asend("PUT", endpoint, f"{id}/", body=kwargs))
 
     def get(self, endpoint: 'str', **kwargs) -> 'dict | list[dict]':
         """Get entity or list of entities"""
@@ -445,40 +1630,100 @@ class ApiService(metaclass=Singleton):
 
         self.send("DELETE", endpoint, f"{id}/")
 
-        del self._cache[id]
+        self._cache.delete(endpoint, id)
+
+    async def aget(self, endpoint: 'str', **kwargs) -> 'dict | list[dict]':
+        """Get entity or list of entities asynchronously"""
+
+        if kwargs.get('id') is not None:
+            return await self._aget(endpoint, kwargs['id'], kwargs.get("force", False))
+
+        return await self._afilter(endpoint, **kwargs)
+
+    async def aset(self, endpoint: 'str', **kwargs) -> 'dict':
+        """Create or update entity asynchronously"""
+
+        if kwargs.get('id') is not None:
+            return await self._aupdate(endpoint, kwargs.pop("id"), **kwargs)
+
+        return await self._acreate(endpoint, **kwargs)
+
+    async def adelete(self, endpoint: 'str', id: 'str') -> 'None':
+        """Delete entity asynchronously"""
+
+        await self.asend("DELETE", endpoint, f"{id}/")
+
+        self._cache.delete(endpoint, id)
+
+    async def abulk(self, endpoint: 'str', items: 'list[dict]') -> 'list[dict]':
+        """
+        Create list of entities with single request asynchronously.
+
+        Expects `POST {endpoint}/bulk/` to return created entities in the same order.
+        If API doesn't provide bulk endpoint, it is emulated by concurrent creations.
+        """
+
+        if endpoint not in self._no_bulk:
+            try:
+                entities = await self.asend("POST", endpoint, "bulk/", body=items)
+            except exceptions.RequestException as ex:
+                if ex.code not in (404, 405):
+                    raise ex
+
+                self._no_bulk.add(endpoint)
+            else:
+                for entity in entities:
+                    self._cache.set(endpoint, entity["id"], entity)
+
+                return entities
+
+        return list(await asyncio.gather(*[self._acreate(endpoint, **item) for item in items]))
 
-    def check_chunk(self, endpoint: 'str', id: 'str', filename: 'str', chunk_number: 'int',
-                    chunk_size: 'int' = 1048576) -> 'bool':
-        """Check if chunk was uploaded on server"""
+    def chunks(self, endpoint: 'str', id: 'str', filename: 'str') -> 'set[int]':
+        """Returns numbers of chunks of file already uploaded on server"""
 
         try:
-            self.send("GET", endpoint, f"{id}/chunk/",
-                      params={"filename": filename, "chunk_number": chunk_number, "chunk_size": chunk_size})
+            return set(self.send("GET", endpoint, f"{id}/chunks/", params={"filename": filename}))
         except exceptions.RequestException as ex:
             if ex.code == 404:
-                return False
+                return set()
             else:
                 raise ex
-        else:
-            return True
 
     def chunk(self, endpoint: 'str', id: 'dict', filename: 'str', chunk: 'bytes', chunk_number: 'int',
               chunk_size: 'int', total_chunks: 'int', total_size: 'int') -> 'None':
         """Send chunk on server"""
 
-        if self.check_chunk(endpoint, id, filename, chunk_number, chunk_size):
-            return
-
         return self.send("POST", endpoint, f"{id}/chunk/",
                          params={"filename": filename, "chunk_number": chunk_number, "total_chunks": total_chunks,
                                  "chunk_size": chunk_size, "total_size": total_size}, files={"chunk": chunk})
 
+    async def achunks(self, endpoint: 'str', id: 'str', filename: 'str') -> 'set[int]':
+        """Returns numbers of chunks of file already uploaded on server asynchronously"""
+
+        try:
+            return set(await self.asend("GET", endpoint, f"{id}/chunks/", params={"filename": filename}))
+        except exceptions.RequestException as ex:
+            if ex.code == 404:
+                return set()
+            else:
+                raise ex
+
+    async def achunk(self, endpoint: 'str', id: 'dict', filename: 'str', chunk: 'bytes', chunk_number: 'int',
+                     chunk_size: 'int', total_chunks: 'int', total_size: 'int') -> 'None':
+        """Send chunk on server asynchronously"""
+
+        return await self.asend("POST", endpoint, f"{id}/chunk/",
+                                params={"filename": filename, "chunk_number": chunk_number,
+                                        "total_chunks": total_chunks, "chunk_size": chunk_size,
+                                        "total_size": total_size}, files={"chunk": chunk})
+
     def send(self, method: 'str', endpoint: 'str', path: 'str', body: 'dict' = None, params: 'dict' = None,
              files: 'dict' = None) -> 'dict | list[dict] | None':
         """Send request to API"""
 
         try:
-            r = requests.request(
+            r = self._session.request(
                 method,
                 os.environ['CELERY_API_URL'] + f"/{endpoint}/{path}",
                 headers={"Accept": "application/json"},
@@ -509,6 +1754,275 @@ class ApiService(metaclass=Singleton):
 
         return r.json()
 
+    def _get_async_session(self) -> 'aiohttp.ClientSession':
+        """Returns pooled keep-alive session bound to the running event loop"""
+
+        loop = asyncio.get_running_loop()
+
+        if self._async_session is None or self._async_session.closed or self._async_loop is not loop:
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size, ssl=False),
+                headers={"Accept": "application/json"}
+            )
+            self._async_loop = loop
+
+        return self._async_session
+
+    async def asend(self, method: 'str', endpoint: 'str', path: 'str', body: 'dict' = None, params: 'dict' = None,
+                    files: 'dict' = None) -> 'dict | list[dict] | None':
+        """Send request to API asynchronously"""
+
+        data = None
+
+        if files is not None:
+            data = aiohttp.FormData()
+
+            for name, value in files.items():
+                data.add_field(name, value, filename=name)
+
+        try:
+            async with self._get_async_session().request(
+                method,
+                os.environ['CELERY_API_URL'] + f"/{endpoint}/{path}",
+                json=body if data is None else None,
+                data=data,
+                params=params
+            ) as r:
+                if r.status >= 400:
+                    raise exceptions.RequestException(r.status, await r.text())
+
+                if r.status == 204:
+                    return None
+
+                return await r.json(content_type=None)
+        except aiohttp.ClientConnectionError as ex:
+            raise exceptions.RequestException(500, str(ex))
+
+    async def aclose(self) -> 'None':
+        """Close pooled connections of the running event loop"""
+
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+
+        self._async_session = None
+        self._async_loop = None
+
+
+class Batch:
+    """Deduplicating batch of items which is dispatched by chunks of `size` items"""
+
+    def __init__(self, dispatch: 'typing.Callable[[list], None]', size: 'int' = 50):
+        self.size = size
+
+        self._dispatch = dispatch
+        self._pending: 'dict[str, object]' = {}
+        self._seen: 'set[str]' = set()
+
+    def add(self, key: 'str', item: 'object') -> 'None':
+        """Add item unless item with the same key was added before"""
+
+        if key in self._seen:
+            return
+
+        self._seen.add(key)
+        self._pending[key] = item
+
+        if len(self._pending) >= self.size:
+            self.flush()
+
+    def flush(self) -> 'None':
+        """Dispatch pending items"""
+
+        if self._pending:
+            items, self._pending = list(self._pending.values()), {}
+
+            self._dispatch(items)
+
+
+class KeyedWorkerPool:
+    """
+    Bounded pool of consumer coroutines.
+
+    Items with the same key are always handled by the same consumer, so they keep
+    the order in which they were put. Producer waits while consumer queue is full.
+    """
+
+    def __init__(self, handler: 'typing.Callable[[object], typing.Awaitable]', concurrency: 'int' = 4,
+                 queue_size: 'int' = 100):
+        self.concurrency = max(1, concurrency)
+
+        self._handler = handler
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in range(self.concurrency)]
+        self._consumers: 'list[asyncio.Task]' = []
+        self._error: 'BaseException | None' = None
+
+    async def __aenter__(self):
+        self._consumers = [asyncio.create_task(self._consume(queue)) for queue in self._queues]
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            for consumer in self._consumers:
+                consumer.cancel()
+
+            await asyncio.gather(*self._consumers, return_exceptions=True)
+
+            return
+
+        for queue in self._queues:
+            await queue.put(None)
+
+        await asyncio.gather(*self._consumers)
+
+        if self._error is not None:
+            raise self._error
+
+    async def _consume(self, queue: 'asyncio.Queue'):
+        while True:
+            item = await queue.get()
+
+            if item is None:
+                return
+
+            try:
+                if self._error is None:
+                    await self._handler(item)
+            except Exception as ex:
+                self._error = ex
+            finally:
+                queue.task_done()
+
+    async def join(self) -> 'None':
+        """Wait until all items put so far are handled"""
+
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+        if self._error is not None:
+            raise self._error
+
+    async def put(self, key: 'typing.Hashable', item: 'object') -> 'None':
+        """Put item in queue of consumer responsible for key"""
+
+        if self._error is not None:
+            raise self._error
+
+        await self._queues[hash(key) % self.concurrency].put(item)
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces deferred entity creations per endpoint into bulk API requests.
+
+    Buffer is flushed when endpoint queue reaches `max_size`, when its oldest
+    item is older than `max_age` seconds, or when the context is exited. Failure
+    of background flush is raised by the next `add` or on exit, so deferred
+    entities are never lost silently.
+    """
+
+    _current: 'contextvars.ContextVar[WriteBehindBuffer | None]' = contextvars.ContextVar(
+        "write_behind_buffer", default=None
+    )
+
+    def __init__(self, max_size: 'int' = None, max_age: 'float' = None):
+        self.max_size = max_size or int(os.environ.get('CELERY_API_BULK_SIZE', 100))
+        self.max_age = max_age or float(os.environ.get('CELERY_API_BULK_AGE', 5))
+
+        self._pending: 'dict[str, list[tuple[models.TypeEntity, dict, asyncio.Future]]]' = {}
+        self._since: 'dict[str, float]' = {}
+        self._flusher: 'asyncio.Task | None' = None
+        self._error: 'BaseException | None' = None
+        self._token = None
+
+    @classmethod
+    def current(cls) -> 'WriteBehindBuffer | None':
+        """Returns buffer opened in current context"""
+
+        return cls._current.get()
+
+    async def __aenter__(self):
+        self._token = self._current.set(self)
+        self._flusher = asyncio.create_task(self._flush_aged())
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._flusher.cancel()
+        self._current.reset(self._token)
+
+        await asyncio.gather(self._flusher, return_exceptions=True)
+
+        await self.flush()
+
+        if self._error is not None and exc_type is None:
+            raise self._error
+
+    async def _flush_aged(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(self.max_age / 2)
+
+            for endpoint, since in list(self._since.items()):
+                if loop.time() - since < self.max_age:
+                    continue
+
+                try:
+                    await self.flush(endpoint)
+                except Exception as ex:
+                    logger.error(f"Write-behind flush of {endpoint} failed. Exception {ex}")
+
+                    self._error = ex
+
+                    return
+
+    async def add(self, entity: 'models.TypeEntity') -> 'asyncio.Future':
+        """Enqueue entity creation, returns future resolved with the entity when it gets `id`"""
+
+        if self._error is not None:
+            raise self._error
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        endpoint = entity.__class__._endpoint
+        pending = self._pending.setdefault(endpoint, [])
+
+        if not pending:
+            self._since[endpoint] = loop.time()
+
+        pending.append((entity, entity.serialize(), future))
+
+        if len(pending) >= self.max_size:
+            await self.flush(endpoint)
+
+        return future
+
+    async def flush(self, endpoint: 'str' = None) -> 'None':
+        """Send pending creations of endpoint (or all endpoints) to API"""
+
+        endpoints = [endpoint] if endpoint is not None else list(self._pending)
+
+        for endpoint in endpoints:
+            pending = self._pending.pop(endpoint, [])
+            self._since.pop(endpoint, None)
+
+            if not pending:
+                continue
+
+            try:
+                results = await ApiService().abulk(endpoint, [body for _, body, _ in pending])
+            except Exception as ex:
+                for _, _, future in pending:
+                    future.set_exception(ex)
+
+                raise ex
+
+            for (entity, _, future), result in zip(pending, results):
+                entity.deserialize(**result)
+
+                future.set_result(entity._identify())
+
 
 LINK_RE = re.compile(
     r'(?:@|(?:https?:\/\/)?(?:www\.)?(?:telegram\.(?:me|dog)|t\.me)\/(?:@|joinchat\/|\+)?|'
@@ -546,6 +2060,8 @@ def parse_username(link: 'str') -> 'tuple[str | None, str | None]':
         else:
             link = link.rstrip('/')
 
+    link = link.lstrip('@')
+
     if telethon.utils.VALID_USERNAME_RE.match(link):
         return link.lower(), False
     else:
@@ -593,3 +2109,35 @@ def get_document_location(document):
     )
 
     return loc, file_size, extension
+
+
+def dump_location(loc: 'types.InputPhotoFileLocation | types.InputDocumentFileLocation') -> 'dict':
+    """Returns JSON serializable representation of file location"""
+
+    return {
+        "type": loc.__class__.__name__,
+        "id": loc.id,
+        "access_hash": loc.access_hash,
+        "file_reference": loc.file_reference.hex(),
+        "thumb_size": loc.thumb_size
+    }
+
+
+def location_key(loc: 'types.InputPhotoFileLocation | types.InputDocumentFileLocation') -> 'str':
+    """Returns key identifying file content regardless of the message it was sent in"""
+
+    return f"{loc.__class__.__name__}:{loc.id}:{loc.thumb_size}"
+
+
+def load_location(data: 'dict') -> 'types.InputPhotoFileLocation | types.InputDocumentFileLocation':
+    """Returns file location from its `dump_location` representation"""
+
+    if data["type"] not in ("InputPhotoFileLocation", "InputDocumentFileLocation"):
+        raise ValueError(f"Unknown file location type {data['type']}.")
+
+    return getattr(types, data["type"])(
+        id=data["id"],
+        access_hash=data["access_hash"],
+        file_reference=bytes.fromhex(data["file_reference"]),
+        thumb_size=data["thumb_size"]
+    )